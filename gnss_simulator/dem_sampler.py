@@ -0,0 +1,97 @@
+import json
+import math
+import os
+import re
+import numpy as np
+
+# Ref: https://www.usgs.gov/centers/eros/science/usgs-eros-archive-digital-elevation-shuttle-radar-topography-mission-srtm-1
+# A .hgt tile is a square grid of big-endian int16 heights in meters covering one degree, named after its south-west
+# corner (e.g. N37W123.hgt), rows running north to south, with 1201 (3 arc-second) or 3601 (1 arc-second) samples a side
+# GeoTIFF DEMs can be converted with: gdal_translate -of SRTMHGT input.tif N37W123.hgt
+HGT_NAME = re.compile(r'^([NS])(\d{2})([EW])(\d{3})\.hgt$', re.IGNORECASE)
+HGT_VOID = -32768
+INDEX_VERSION = 1
+
+class DemSampler:
+    def __init__(self, directory, index_path=None):
+        # Elevation from local SRTM tiles, an offline replacement for MapAPIClient.get_opentopo_elevation_batch
+        # directory: searched recursively for .hgt tiles
+        # index_path: JSON index of the tiles found (default: dem_index.json in the directory),
+        # rebuilt when the directory was modified after it (tiles added or removed at its top level);
+        # where it can't be written (e.g. a read-only DEM directory) the index is only kept in memory
+        self.directory = directory
+        self.index_path = index_path if index_path is not None else os.path.join(directory, "dem_index.json")
+        self.tiles = self.__load_index()
+        self.grids = {}  # tile name -> memory-mapped grid, opened on first use
+
+    def __load_index(self):
+        if os.path.exists(self.index_path) and os.path.getmtime(self.directory) <= os.path.getmtime(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                return index['tiles']
+
+        tiles = {}
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if HGT_NAME.match(name):
+                    path = os.path.join(root, name)
+                    size = math.isqrt(os.path.getsize(path) // 2)
+                    tiles[name[:7].upper()] = {'path': os.path.relpath(path, self.directory), 'size': size}
+        index = {'version': INDEX_VERSION, 'tiles': tiles}
+        print(f"DEM index built with {len(tiles)} tiles in {self.directory}")
+        try:
+            with open(self.index_path, 'w') as f:
+                json.dump(index, f, indent=1)
+        except OSError as e:
+            print(f"WARNING: DEM index not saved ({e}), it is rebuilt next time; pass index_path to keep it elsewhere.")
+        return tiles
+
+    def __grid(self, name):
+        # Only the pages holding the samples read are ever loaded from disk
+        if name not in self.grids:
+            tile = self.tiles[name]
+            self.grids[name] = np.memmap(os.path.join(self.directory, tile['path']), dtype='>i2', mode='r',
+                                         shape=(tile['size'], tile['size']))
+        return self.grids[name]
+
+    def tile_name(self, south, west):
+        return f"{'N' if south >= 0 else 'S'}{abs(south):02d}{'E' if west >= 0 else 'W'}{abs(west):03d}"
+
+    def sample(self, lats, lons):
+        # Bilinear interpolation of the heights around every point, vectorized per tile
+        # Returns float64 meters, NaN where no tile covers a point or all four samples around it are voids
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        elevations = np.full(len(lats), np.nan)
+        souths = np.floor(lats).astype(np.int64)
+        wests = np.floor(lons).astype(np.int64)
+        corners, tile_of_point = np.unique(np.column_stack((souths, wests)), axis=0, return_inverse=True)
+        missing = []
+        for tile, (south, west) in enumerate(corners.tolist()):
+            name = self.tile_name(south, west)
+            if name not in self.tiles:
+                missing.append(name)
+                continue
+            points = np.flatnonzero(tile_of_point.ravel() == tile)
+            grid = self.__grid(name)
+            cells = grid.shape[0] - 1
+
+            # Fractional row (from the north edge) and column (from the west edge) of every point
+            row = (south + 1 - lats[points]) * cells
+            col = (lons[points] - west) * cells
+            row0 = np.clip(np.floor(row).astype(np.int64), 0, cells - 1)
+            col0 = np.clip(np.floor(col).astype(np.int64), 0, cells - 1)
+            fy = row - row0
+            fx = col - col0
+
+            # Voids get no weight and the remaining samples are renormalized, every valid sample keeps a tiny weight
+            # so a point right on a void still gets the average of its neighbors
+            heights = np.stack([grid[row0, col0], grid[row0, col0 + 1], grid[row0 + 1, col0], grid[row0 + 1, col0 + 1]]).astype(np.float64)
+            weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx])
+            weights = np.where(heights == HGT_VOID, 0, np.maximum(weights, 1e-9))
+            total = weights.sum(axis=0)
+            elevations[points] = np.divide((weights * heights).sum(axis=0), total, out=np.full(len(points), np.nan), where=total > 0)
+        if missing:
+            print(f"WARNING: No DEM tile for {', '.join(missing)}, elevation left empty there.")
+        return elevations
@@ -15,6 +15,12 @@ waypoints = [
 
 print ("\nInitializing DriveSimulator")
 drive_sim = GnssSimulator()
+# Offline elevation: sample local SRTM .hgt tiles (e.g. N37W123.hgt) instead of the OpenTopoData API
+# from dem_sampler import DemSampler
+# drive_sim = GnssSimulator(elevation_sampler=DemSampler('srtm_tiles'))
+# Routes are cached in osrm_routes.sqlite; to use a local router instead of the public one:
+# from map_api_client import MapAPIClient
+# drive_sim.map_api_obj = MapAPIClient(router_url='http://localhost:5000')
 drive_sim.add_waypoints(waypoints)
 
 print ("\nCalculating route and simulating virtual drive")
@@ -22,11 +28,16 @@ drive_sim.calculate_route()
 drive_sim.simulate_virtual_drive()
 # drive_sim.simulate_virtual_drive(45, 10) # Manually set speed and distance
 drive_sim.save_virtual_drive()
+# Typed, compressed columns instead: drive_sim.save_virtual_drive('demo_virtual_drive.parquet')
+# Long drives can skip memory entirely: drive_sim.stream_virtual_drive('long_drive.parquet', 30, 100)
 drive_sim.show_metrics()
 
 print ("\nVisualizing route and drive")
 drive_sim.plot_interactive_map()
 drive_sim.plot_static_map() # Set zoom level automatically
+# Tiles are kept in osm_tiles.mbtiles, seed it to render offline later:
+# bb = drive_sim.bounding_box
+# drive_sim.map_api_obj.seed_tiles(bb.min_lat, bb.min_lon, bb.max_lat, bb.max_lon, range(8, 13))
 # drive_sim.plot_static_map(12)  # Set zoom level manually
 
 
@@ -1,18 +1,69 @@
 from map_api_client import MapAPIClient
+from trajectory_parquet import TrajectoryWriter, ROW_GROUP_SIZE
 import matplotlib.pyplot as plt
 from mpl_toolkits.basemap import Basemap
 from PIL import Image
 import math
+import numpy as np
 import plotly.graph_objects as go
 import pandas as pd
-from geopy.distance import geodesic
+
+WGS84_A = 6378137.0  # semi-major axis in meters
+WGS84_E2 = 6.69437999014e-3  # first eccentricity squared
+# Absolute coordinates are always float64: float32 steps are ~1 m in longitude
+COORDINATE_DTYPE = np.float64
 
 class Waypoint:
+    # A single point, e.g. one row of a Trajectory; slots keep it small when many are created
+    __slots__ = ('lat', 'lon', 'alt')
+
     def __init__(self, lat, lon, alt=None):
         self.lat = lat
         self.lon = lon
         self.alt = alt
 
+class Trajectory:
+    # Column of virtual_drive_df holding every trajectory column
+    COLUMNS = {'time': 'timestamp_s', 'lat': 'latitude_deg', 'lon': 'longitude_deg', 'alt': 'altitude_m', 'speed': 'speed_m_per_s'}
+
+    def __init__(self, lat, lon, alt=None, time=None, speed=None):
+        # Points stored column by column in contiguous arrays, instead of one Waypoint object each
+        # Positions (COORDINATE_DTYPE) and time stay float64, altitude and speed are float32
+        # A missing altitude is NaN, time and speed are None when the trajectory has none (e.g. a route)
+        self.lat = np.ascontiguousarray(lat, dtype=COORDINATE_DTYPE)
+        self.lon = np.ascontiguousarray(lon, dtype=COORDINATE_DTYPE)
+        self.alt = self.__column(np.nan if alt is None else alt, np.float32)
+        self.time = None if time is None else self.__column(time, np.float64)
+        self.speed = None if speed is None else self.__column(speed, np.float32)
+
+    def __column(self, values, dtype):
+        # Scalars are broadcast to the length of the trajectory
+        if np.ndim(values) == 0:
+            return np.full(len(self.lat), values, dtype=dtype)
+        return np.ascontiguousarray(values, dtype=dtype)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __getitem__(self, index):
+        # An integer gives that point as a Waypoint, a slice gives a Trajectory of views into the same arrays
+        if isinstance(index, slice):
+            return Trajectory(**{name: None if getattr(self, name) is None else getattr(self, name)[index] for name in self.COLUMNS})
+        alt = float(self.alt[index])
+        return Waypoint(float(self.lat[index]), float(self.lon[index]), None if math.isnan(alt) else alt)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.COLUMNS if getattr(self, name) is not None)
+
+    def to_dataframe(self):
+        # DataFrame with the virtual drive CSV columns, backed by the trajectory arrays without copying them
+        return pd.DataFrame({column: getattr(self, name) for name, column in self.COLUMNS.items() if getattr(self, name) is not None}, copy=False)
+
 class BoundingBox:
     def __init__(self, waypoints):
         self.min_lat = min(wp.lat for wp in waypoints)
@@ -33,14 +84,18 @@ class BoundingBox:
         return Waypoint(self.max_lat, self.max_lon)
 
 class GnssSimulator:
-    def __init__(self):
+    def __init__(self, elevation_sampler=None, map_api_obj=None):
+        # elevation_sampler: e.g. DemSampler(directory) to read route elevations from local DEM tiles,
+        # instead of the rate-limited OpenTopoData API
+        # map_api_obj: MapAPIClient to use, e.g. one with a local router, MapAPIClient() by default
         self.waypoints = None
         self.bounding_box = None
         self.route = None
         self.virtual_drive = None
         self.virtual_drive_df = None
         self.zoom = None
-        self.map_api_obj = MapAPIClient()
+        self.map_api_obj = map_api_obj if map_api_obj is not None else MapAPIClient()
+        self.elevation_sampler = elevation_sampler
 
     def add_waypoints(self, waypoints):
         self.waypoints = waypoints
@@ -49,103 +104,90 @@ class GnssSimulator:
         self.bounding_box = BoundingBox(waypoints)
 
     def calculate_route(self):
-        route = []
-        for i in range(len(self.waypoints) - 1):
-            route_segment = self.__generate_route_segment(self.waypoints[i], self.waypoints[i + 1])
-            route.extend(route_segment[:-1]) # skip last point
-        route.append(route_segment[-1])
-        self.route = route
-
-    def __generate_route_segment(self, start, end):
-        # Calculate route lat/lon
-        route = self.map_api_obj.get_osrm_route(start, end)
-        route = [Waypoint(lat, lon) for lon, lat in route['routes'][0]['geometry']['coordinates']]
+        self.route = self.__generate_route(self.waypoints)
+
+    def __generate_route(self, waypoints):
+        # Calculate route lat/lon, one request through all waypoints
+        route = self.map_api_obj.get_osrm_route(*waypoints)
+        coordinates = np.array(route['routes'][0]['geometry']['coordinates'], dtype=np.float64)
+        route = Trajectory(coordinates[:, 1], coordinates[:, 0])
 
         # Calculate route elevation
-        elevations = self.map_api_obj.get_opentopo_elevation_batch(route)
-        for i in range(len(route)):
-            route[i].alt = elevations[i]
+        if self.elevation_sampler is not None:
+            route.alt[:] = self.elevation_sampler.sample(route.lat, route.lon)
+        else:
+            elevations = self.map_api_obj.get_opentopo_elevation_batch(route)
+            route.alt[:] = [np.nan if elevation is None else elevation for elevation in elevations]
 
         return route
 
     def simulate_virtual_drive(self, speed = 30, freq = 10):
         # Spees in m/s, frequency in Hz
-        distance_per_timestep = speed / freq
-
+        route_distance = self.__route_distance()
+        self.virtual_drive = self.__drive_samples(route_distance, speed, freq, 0, self.__num_samples(route_distance, speed, freq))
+
+        # The DataFrame shares the arrays of the trajectory
+        self.virtual_drive_df = self.virtual_drive.to_dataframe()
+
+    def stream_virtual_drive(self, filename, speed = 30, freq = 10, row_group_size=ROW_GROUP_SIZE):
+        # Simulate the drive straight into a Parquet file one row group at a time, for drives too long to keep in memory
+        # The file holds the same samples simulate_virtual_drive would give, which is left untouched
+        route_distance = self.__route_distance()
+        num_samples = self.__num_samples(route_distance, speed, freq)
+        with TrajectoryWriter(filename, row_group_size) as writer:
+            for start in range(0, num_samples, row_group_size):
+                writer.write(self.__drive_samples(route_distance, speed, freq, start, min(start + row_group_size, num_samples)))
+        print(f"Virtual drive data streamed to {filename} ({num_samples} samples)")
+
+    def __route_distance(self):
         if self.route is None:
             raise ValueError("No route calculated. Please calculate the route before simulating the drive.")
+        return self.__cumulative_distance(self.route.lat, self.route.lon)
 
-        self.virtual_drive = []
-        carryover_distance = 0
-        for i in range(1,len(self.route)):
-            segment_start = self.route[i-1]
-            segment_end = self.route[i]
-            segment_length = self.__distance(segment_start, segment_end)
-
-            if carryover_distance > segment_length:
-                carryover_distance -= segment_length
-                continue
-
-            # Calculate offset
-            param = carryover_distance / segment_length
-            offset = self.__interpolate(segment_start, segment_end, param)
-            self.virtual_drive.append(offset)
-
-            # Calculate all other waypoints
-            remaining_segment_length = self.__distance(offset, segment_end)
-            num_steps = int(remaining_segment_length / distance_per_timestep)
-            for j in range(1, num_steps + 1):
-                distance_from_offset = j * distance_per_timestep
-                param = distance_from_offset / remaining_segment_length
-                wp = self.__interpolate(offset, segment_end, param)
-                self.virtual_drive.append(wp)
-
-            # Calculate residual distance to carry over to next segment
-            carryover_distance = ((num_steps + 1) * distance_per_timestep) - remaining_segment_length
-
-        # Populate the virtual drive DataFrame
-        self.virtual_drive_df = pd.DataFrame()
-        start_epoch = pd.Timestamp(year=2025, month=1, day=1, hour=12).timestamp()
-        self.virtual_drive_df['timestamp_s'] = [start_epoch + i / freq for i in range(len(self.virtual_drive))]
-        self.virtual_drive_df['latitude_deg'] = [wp.lat for wp in self.virtual_drive]
-        self.virtual_drive_df['longitude_deg'] = [wp.lon for wp in self.virtual_drive]
-        self.virtual_drive_df['altitude_m'] = [wp.alt for wp in self.virtual_drive]
-        self.virtual_drive_df['speed_m_per_s'] = speed
-
-    def __interpolate(self, waypoint1, waypoint2, param):
-        # Interpolate between two waypoints
-        # 0 <= param <= 1
-        # param = 0 means waypoint1, param = 1 means waypoint2
-        if param < 0 or param > 1:
-            raise ValueError("Param must be between 0 and 1.")
-
-        lat1, lon1, alt1 = waypoint1.lat, waypoint1.lon, waypoint1.alt
-        lat2, lon2, alt2 = waypoint2.lat, waypoint2.lon, waypoint2.alt
-        lat = round(lat1 + (lat2 - lat1) * param, 7) # 7 decimal places means ~1cm accuracy
-        lon = round(lon1 + (lon2 - lon1) * param, 7)
-        if alt1 is not None and alt2 is not None:
-            alt = round(alt1 + (alt2 - alt1) * param, 2)
-        else:
-            alt = None
-        return Waypoint(lat, lon, alt)
+    def __num_samples(self, route_distance, speed, freq):
+        return int(route_distance[-1] / (speed / freq)) + 1
 
-    def __distance(self, waypoint1, waypoint2):
-        # Calculate the distance between two waypoints in meters
-        lat1, lon1 = waypoint1.lat, waypoint1.lon
-        lat2, lon2 = waypoint2.lat, waypoint2.lon
-        dist = geodesic((lat1, lon1), (lat2, lon2)).km * 1000
-        return dist
+    def __drive_samples(self, route_distance, speed, freq, start, stop):
+        # Samples start to stop (excluded) of the drive
+        # One sample every distance_per_timestep meters along the route, placed on its segment by linear interpolation
+        distance_per_timestep = speed / freq
+        route = self.route
+        sample_distance = np.arange(start, stop) * distance_per_timestep
+        start_epoch = pd.Timestamp(year=2025, month=1, day=1, hour=12).timestamp()
+        return Trajectory(
+            np.interp(sample_distance, route_distance, route.lat).round(7), # 7 decimal places means ~1cm accuracy
+            np.interp(sample_distance, route_distance, route.lon).round(7),
+            np.interp(sample_distance, route_distance, route.alt).round(2),
+            start_epoch + np.arange(start, stop) / freq,
+            speed
+        )
+
+    def __cumulative_distance(self, lats, lons):
+        # Distance in meters from the first point at every point of a polyline, vectorized over all of its segments
+        # Each segment is measured on the plane tangent to the WGS84 ellipsoid at its midpoint,
+        # which agrees with the geodesic distance to well under a millimeter for segments of a few kilometers
+        lat1, lat2 = np.radians(lats[:-1]), np.radians(lats[1:])
+        mid_lat = (lat1 + lat2) / 2
+        w = np.sqrt(1 - WGS84_E2 * np.sin(mid_lat) ** 2)
+        north = (lat2 - lat1) * WGS84_A * (1 - WGS84_E2) / w ** 3
+        east = np.radians(np.diff(lons)) * WGS84_A / w * np.cos(mid_lat)
+        return np.concatenate(([0.0], np.cumsum(np.hypot(north, east))))
 
     def save_virtual_drive(self, filename = "demo_virtual_drive.csv"):
         if self.virtual_drive_df is None:
             raise ValueError("No virtual drive simulated. Please simulate the drive before saving.")
-        self.virtual_drive_df.to_csv(filename, index=False)
+        # A .parquet file gets typed, compressed columns in row groups (see TrajectoryWriter), anything else CSV
+        if filename.endswith('.parquet'):
+            with TrajectoryWriter(filename) as writer:
+                writer.write(self.virtual_drive)
+        else:
+            self.virtual_drive_df.to_csv(filename, index=False)
         print(f"Virtual drive data saved to {filename}")
 
     def show_metrics(self):
         print("#" * 20)
         if self.route:
-            total_distance = sum(self.__distance(self.route[i], self.route[i + 1]) for i in range(len(self.route) - 1))
+            total_distance = self.__cumulative_distance(self.route.lat, self.route.lon)[-1]
             print("Route Metrics:")
             print(f"  - Number of waypoints: {len(self.route)}")
             print(f"  - Route length: {total_distance:.2f} meters")
@@ -204,16 +246,12 @@ class GnssSimulator:
 
         # Plot route
         if self.route:
-            lats = [wp.lat for wp in self.route]
-            lons = [wp.lon for wp in self.route]
-            x, y = basemap_obj(lons, lats)
+            x, y = basemap_obj(self.route.lon, self.route.lat)
             basemap_obj.plot(x, y, marker='o', color='b', markersize=4, linewidth=1, label='Route')
 
         # Plot virtual drive
         if self.virtual_drive:
-            lats = [wp.lat for wp in self.virtual_drive]
-            lons = [wp.lon for wp in self.virtual_drive]
-            x, y = basemap_obj(lons, lats)
+            x, y = basemap_obj(self.virtual_drive.lon, self.virtual_drive.lat)
             basemap_obj.plot(x, y, marker='o', color='g', markersize=2, linewidth=1, label='Virtual Drive')
 
         plt.legend()
@@ -247,12 +285,12 @@ class GnssSimulator:
         stitched_height = (max_y - min_y + 1) * tile_height
         stitched_map = Image.new('RGB', (stitched_width, stitched_height))
 
-        for x in range(min_x, max_x + 1):
-            for y in range(min_y, max_y + 1):
-                tile = self.map_api_obj.get_tile(x, y, self.zoom)
-                if tile.mode == 'P':
-                    tile = tile.convert('RGB')
-                stitched_map.paste(tile, ((x - min_x) * tile_width, (y - min_y) * tile_height))
+        # Tiles are fetched and decoded concurrently, each one is pasted as soon as it is ready
+        tiles = [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+        for (x, y), tile in self.map_api_obj.get_tiles(tiles, self.zoom):
+            if tile.mode == 'P':
+                tile = tile.convert('RGB')
+            stitched_map.paste(tile, ((x - min_x) * tile_width, (y - min_y) * tile_height))
 
         return stitched_map
 
@@ -300,21 +338,11 @@ class GnssSimulator:
 
         # Plot route
         if self.route:
-            df = pd.DataFrame({
-                'latitude': [wp.lat for wp in self.route],
-                'longitude': [wp.lon for wp in self.route],
-                'altitude': [wp.alt for wp in self.route]
-            })
-            fig.add_scattermap(mode='lines+markers', lat=df['latitude'], lon=df['longitude'], marker=dict(size=14, color='blue'), name='Route', text=[f"Altitude: {alt} m" for alt in df['altitude']])
+            fig.add_scattermap(mode='lines+markers', lat=self.route.lat, lon=self.route.lon, marker=dict(size=14, color='blue'), name='Route', text=[f"Altitude: {alt} m" for alt in self.route.alt.tolist()])
 
         # Plot virtual drive
         if self.virtual_drive:
-            df = pd.DataFrame({
-                'latitude': [wp.lat for wp in self.virtual_drive],
-                'longitude': [wp.lon for wp in self.virtual_drive],
-                'altitude': [wp.alt for wp in self.virtual_drive]
-            })
-            fig.add_scattermap(mode='lines+markers', lat=df['latitude'], lon=df['longitude'], marker=dict(size=8, color='green'), name='Virtual Drive', text=[f"Altitude: {alt} m" for alt in df['altitude']])
+            fig.add_scattermap(mode='lines+markers', lat=self.virtual_drive.lat, lon=self.virtual_drive.lon, marker=dict(size=8, color='green'), name='Virtual Drive', text=[f"Altitude: {alt} m" for alt in self.virtual_drive.alt.tolist()])
 
         fig.show(renderer="browser")
 
@@ -1,45 +1,147 @@
-import os
+import threading
+import time
 from time import sleep 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import math
 from io import BytesIO
 from PIL import Image, ImageOps
+from tile_store import TileStore
+from route_cache import RouteCache
+
+# Any slippy map tile server works, e.g. a local stand-in serving a z/x/y directory: python -m http.server 8000
+TILE_URL = "https://a.tile.openstreetmap.org/{zoom}/{xtile}/{ytile}.png"
+# Any OSRM server works, e.g. a local osrm-backend: http://localhost:5000
+ROUTER_URL = "http://router.project-osrm.org"
+USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/113.0'
+
+class RateLimiter:
+    def __init__(self, rate=None, concurrency=2):
+        # Limits the requests sent to one host: at most rate per second (None for no limit) and concurrency at a time
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def __enter__(self):
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        self.slots.release()
 
 
 class MapAPIClient:
-    def __init__(self):
-        # Create a directory to store the tiles
-        self.cache_path = "osm_tiles"
-        if not os.path.exists(self.cache_path):
-            os.mkdir(self.cache_path)
-    
-    def get_tile(self, xtile, ytile, zoom):
-        # Download and cache the tile if it doesn't exist
-        path = self.cache_path + f"/{zoom}_{xtile}_{ytile}.png"
-        if not os.path.exists(path):
-            tile = self.download_tile(xtile, ytile, zoom)
-            with open(path, "wb") as f:
-                f.write(tile)
-
-        # Read the tile from the cache
-        with open(path, "rb") as f:
-                tile = f.read()
-        tile = Image.open(BytesIO(tile))
-
-        # Add mild blue edge to each tile
+    def __init__(self, tile_url=TILE_URL, workers=8, host_rate=None, host_concurrency=2, retries=3, backoff=0.5, tile_store=None,
+                 router_url=ROUTER_URL, route_profile='driving', route_cache=None):
+        # tile_url: tile server URL template with {zoom}, {xtile} and {ytile}
+        # tile_store: TileStore the tiles are cached in, TileStore("osm_tiles.mbtiles") opened on the first tile by default
+        # router_url, route_profile: OSRM server and routing profile
+        # route_cache: RouteCache the routes are cached in, RouteCache("osrm_routes.sqlite") by default
+        # workers: tiles downloaded and decoded at once
+        # host_rate, host_concurrency: requests per second (None for no limit) and requests in flight allowed per host,
+        # the public OSM tile servers ask for no more than two connections
+        # retries, backoff: failed requests (connection errors, 429 and 5xx) are retried after backoff * 2^n seconds,
+        # or after the Retry-After the server asks for
+        self.tile_url = tile_url
+        self.router_url = router_url
+        self.route_profile = route_profile
+        self.route_cache = route_cache if route_cache is not None else RouteCache()
+        self.workers = workers
+        self.host_rate = host_rate
+        self.host_concurrency = host_concurrency
+        self.limiters = {}  # host -> RateLimiter
+        self.limiters_lock = threading.Lock()
+
+        # One pooled session, so requests to the same host reuse their connections
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']), respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(workers, host_concurrency), max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Downloaded tiles are kept in one MBTiles file, decoded ones in its in-memory LRU
+        self.__tile_store = tile_store
+        self.tile_store_lock = threading.Lock()
+
+        # Mild blue edge added to each tile
         blue_border = Image.new('RGB',(254,254),(0,0,0))
-        blue_border = ImageOps.expand(blue_border, border=1, fill=(0,0,255))
+        self.blue_border = ImageOps.expand(blue_border, border=1, fill=(0,0,255))
         mask = Image.new('L',(254,254),(255))
-        mask = ImageOps.expand(mask, border=1, fill=(200))
-        tile = Image.composite(tile, blue_border, mask)
+        self.border_mask = ImageOps.expand(mask, border=1, fill=(200))
+
+    @property
+    def tile_store(self):
+        # Clients that only route or fetch elevations (e.g. batch workers) never open the MBTiles file
+        with self.tile_store_lock:
+            if self.__tile_store is None:
+                self.__tile_store = TileStore()
+            return self.__tile_store
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(self.host_rate, self.host_concurrency)
+            return self.limiters[host]
 
+    def get(self, url, **kwargs):
+        # Rate limited GET through the pooled session
+        with self.limiter(url):
+            return self.session.get(url, **kwargs)
+
+    def get_tiles(self, tiles, zoom):
+        # Download (when not cached) and decode many tiles concurrently
+        # tiles: iterable of (xtile, ytile), yields ((xtile, ytile), tile image) as each one is ready
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = {pool.submit(self.get_tile, xtile, ytile, zoom): (xtile, ytile) for xtile, ytile in tiles}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def get_tile(self, xtile, ytile, zoom):
+        # Tiles decoded before come straight from memory, the returned image is shared and must not be modified
+        tile = self.tile_store.get_image(xtile, ytile, zoom)
+        if tile is not None:
+            return tile
+
+        # Download and store the tile if it doesn't exist
+        data = self.tile_store.get(xtile, ytile, zoom)
+        if data is None:
+            data = self.download_tile(xtile, ytile, zoom)
+            self.tile_store.put(xtile, ytile, zoom, data)
+
+        # Decode the tile and add the border once
+        tile = Image.composite(Image.open(BytesIO(data)), self.blue_border, self.border_mask)
+        self.tile_store.put_image(xtile, ytile, zoom, tile)
         return tile
-    
+
+    def seed_tiles(self, min_lat, min_lon, max_lat, max_lon, zooms):
+        # Download every tile of a bounding box at the given zoom levels that is not stored yet, e.g. before going offline
+        for zoom in zooms:
+            min_x, min_y = self.deg2tilenum(max_lat, min_lon, zoom)
+            max_x, max_y = self.deg2tilenum(min_lat, max_lon, zoom)
+            stored = self.tile_store.stored(min_x, max_x, min_y, max_y, zoom)
+            missing = [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1) if (x, y) not in stored]
+            with ThreadPoolExecutor(self.workers) as pool:
+                for (x, y), data in zip(missing, pool.map(lambda tile: self.download_tile(tile[0], tile[1], zoom), missing)):
+                    self.tile_store.put(x, y, zoom, data)
+            print(f"Zoom {zoom}: {len(stored)} tiles already stored, {len(missing)} downloaded")
+
     def download_tile(self, xtile, ytile, zoom):
-        url = f"https://a.tile.openstreetmap.org/{zoom}/{xtile}/{ytile}.png"
+        url = self.tile_url.format(zoom=zoom, xtile=xtile, ytile=ytile)
         print(f"Downloading {url}")
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/113.0'}
-        response = requests.get(url, headers=headers)
+        response = self.get(url, timeout=30)
         response.raise_for_status()
         return response.content
     
@@ -58,11 +160,27 @@ class MapAPIClient:
         lat_deg = math.degrees(lat_rad)
         return (lat_deg, lon_deg)
     
-    def get_osrm_route(self, start, end):
-        url = f"http://router.project-osrm.org/route/v1/driving/{start.lon},{start.lat};{end.lon},{end.lat}?overview=full&geometries=geojson"
-        print(f"Fetching route from OSRM: from ({start.lat}, {start.lon}) to ({end.lat}, {end.lon})")
-        response = requests.get(url)
-        return response.json()
+    def get_osrm_route(self, *waypoints):
+        # One request for the whole route through all waypoints (at least two), its geometry covers every leg
+        coordinates = ";".join(f"{wp.lon},{wp.lat}" for wp in waypoints)
+        key = self.route_cache.key(self.router_url, self.route_profile, coordinates)
+        route = self.route_cache.get(key)
+        if route is not None:
+            return route
+
+        url = f"{self.router_url}/route/v1/{self.route_profile}/{coordinates}?overview=full&geometries=geojson"
+        print(f"Fetching route from OSRM: from ({waypoints[0].lat}, {waypoints[0].lon}) to ({waypoints[-1].lat}, {waypoints[-1].lon}) through {len(waypoints)} waypoints")
+        response = self.get(url, timeout=60)
+        route = response.json()
+        if route.get('code') != 'Ok':
+            raise ValueError(f"OSRM could not calculate the route: {route.get('message', route.get('code'))}")
+        self.route_cache.put(key, route)
+        return route
+
+    def get_osrm_routes(self, routes):
+        # Several routes (each a list of waypoints) requested concurrently, e.g. the legs of a batch of scenarios
+        with ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(lambda waypoints: self.get_osrm_route(*waypoints), routes))
 
     # Ref: https://www.opentopodata.org/
     def get_opentopo_elevation_batch(self, waypoints, batch_size=100):
@@ -86,7 +204,7 @@ class MapAPIClient:
         url = "https://api.opentopodata.org/v1/aster30m?locations="
         locations = "|".join([f"{w.lat},{w.lon}" for w in waypoints])
         print(f"Fetching elevation data from OpenTopo for {len(waypoints)} waypoints")
-        response = requests.get(url + locations)
+        response = self.get(url + locations)
 
         if response.status_code == 200:
             data = response.json()
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+from replay_streamer import ReplayStream, replay_streams
+
+# Any virtual drive works, e.g. drive_sim.virtual_drive_df right after drive_sim.simulate_virtual_drive()
+drive_df = pd.read_csv('demo_virtual_drive.csv')
+
+# Ten 10 Hz drives replayed 10x faster (100 Hz each) to local UDP ports, in every message format
+# Consume one with map_engine: read_gnss_socket('127.0.0.1', 10110, 'udp')
+formats = ['csv', 'nmea', 'binary']
+streams = [ReplayStream(drive_df, '127.0.0.1', 10110 + i, message_format=formats[i % 3], speedup=10) for i in range(10)]
+# TCP instead: ReplayStream(drive_df, '127.0.0.1', 10110, protocol='tcp') waits for read_gnss_socket('127.0.0.1', 10110, 'tcp')
+replay_streams(streams)
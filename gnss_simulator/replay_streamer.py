@@ -0,0 +1,168 @@
+import asyncio
+import socket
+import struct
+from datetime import datetime, timezone
+import numpy as np
+
+# Binary record: sequence number, timestamp_s, latitude_deg, longitude_deg (float64), altitude_m, speed_m_per_s (float32),
+# little-endian, 36 bytes; the sequence number shows the fixes a UDP consumer missed
+BINARY_RECORD = struct.Struct('<Idddff')
+MESSAGE_FORMATS = ('csv', 'nmea', 'binary')
+# A TCP consumer with more than this many bytes not yet sent misses fixes until it catches up
+MAX_CLIENT_BACKLOG = 2**20
+
+def nmea_sentence(body):
+    checksum = 0
+    for char in body.encode('ascii'):
+        checksum ^= char
+    return f"${body}*{checksum:02X}\r\n"
+
+def nmea_coordinate(value, degree_digits, hemispheres):
+    # ddmm.mmmmm (dddmm.mmmmm for longitudes) and its hemisphere letter
+    minutes = round(abs(value) * 60, 5)
+    degrees = int(minutes // 60)
+    return f"{degrees:0{degree_digits}d}{minutes - degrees * 60:08.5f}", hemispheres[value < 0]
+
+class ReplayStream:
+    def __init__(self, drive_df, host, port, protocol='udp', message_format='csv', speedup=1.0, wait_for_client=True, name=None):
+        # Replays a virtual drive (GnssSimulator.virtual_drive_df, or a drive CSV read with pandas) as a live feed,
+        # every fix sent at its timestamp (divided by speedup) after the first one
+        # protocol: 'udp' sends datagrams to host:port (e.g. to map_engine's read_gnss_socket(host, port, 'udp')),
+        # 'tcp' listens on host:port and sends the feed to every connected consumer (read_gnss_socket(host, port, 'tcp'))
+        # message_format: 'csv' lines (timestamp_s,latitude_deg,longitude_deg,altitude_m,speed_m_per_s),
+        # 'nmea' GGA and RMC sentences, or 'binary' records (see BINARY_RECORD)
+        # wait_for_client: with TCP, start the replay once the first consumer connected so it misses no fix
+        if protocol not in ('udp', 'tcp'):
+            raise ValueError("Protocol must be 'udp' or 'tcp'.")
+        if message_format not in MESSAGE_FORMATS:
+            raise ValueError(f"Message format must be one of {', '.join(MESSAGE_FORMATS)}.")
+        if speedup <= 0:
+            raise ValueError("Speedup must be positive.")
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.message_format = message_format
+        self.speedup = speedup
+        self.wait_for_client = wait_for_client
+        self.name = name if name is not None else f"{protocol}://{host}:{port}"
+
+        self.time = drive_df['timestamp_s'].to_numpy(dtype=np.float64)
+        self.lat = drive_df['latitude_deg'].to_numpy(dtype=np.float64)
+        self.lon = drive_df['longitude_deg'].to_numpy(dtype=np.float64)
+        self.alt = drive_df['altitude_m'].to_numpy(dtype=np.float64) if 'altitude_m' in drive_df else np.full(len(self.time), np.nan)
+        self.speed = drive_df['speed_m_per_s'].to_numpy(dtype=np.float64) if 'speed_m_per_s' in drive_df else np.zeros(len(self.time))
+        if len(self.time) < 2:
+            raise ValueError("At least two fixes are required to replay a drive.")
+        # Course over ground towards the next fix, for the RMC sentences
+        lat = np.radians(self.lat)
+        course = np.degrees(np.arctan2(np.radians(np.diff(self.lon)) * np.cos(lat[:-1]), np.diff(lat))) % 360
+        self.course = np.append(course, course[-1])
+
+        self.clients = set()
+        self.connected = None
+        self.dropped = 0
+
+    def encode(self, i):
+        t, lat, lon, alt, speed = float(self.time[i]), float(self.lat[i]), float(self.lon[i]), float(self.alt[i]), float(self.speed[i])
+        if self.message_format == 'binary':
+            return BINARY_RECORD.pack(i & 0xFFFFFFFF, t, lat, lon, alt, speed)
+        if self.message_format == 'csv':
+            return f"{t:.3f},{lat:.7f},{lon:.7f},{alt:.2f},{speed:.2f}\n".encode('ascii')
+
+        utc = datetime.fromtimestamp(t, timezone.utc)
+        hhmmss = f"{utc:%H%M%S}.{utc.microsecond // 10000:02d}"
+        lat_text, lat_hemisphere = nmea_coordinate(lat, 2, 'NS')
+        lon_text, lon_hemisphere = nmea_coordinate(lon, 3, 'EW')
+        alt_text = '' if alt != alt else f"{alt:.1f}"
+        gga = f"GPGGA,{hhmmss},{lat_text},{lat_hemisphere},{lon_text},{lon_hemisphere},1,08,0.9,{alt_text},M,0.0,M,,"
+        rmc = (f"GPRMC,{hhmmss},A,{lat_text},{lat_hemisphere},{lon_text},{lon_hemisphere},"
+               f"{speed * 3600 / 1852:.2f},{self.course[i]:.1f},{utc:%d%m%y},,,A")
+        return (nmea_sentence(gga) + nmea_sentence(rmc)).encode('ascii')
+
+    async def accept(self, reader, writer):
+        self.clients.add(writer)
+        self.connected.set()
+        try:
+            await reader.read()  # consumers send nothing, this returns when they disconnect
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def broadcast(self, data):
+        for writer in list(self.clients):
+            if writer.transport.is_closing():
+                self.clients.discard(writer)
+            elif writer.transport.get_write_buffer_size() > MAX_CLIENT_BACKLOG:
+                self.dropped += 1
+            else:
+                writer.write(data)
+
+    async def run(self):
+        # Send the whole drive, returns the achieved rate and timing jitter
+        loop = asyncio.get_running_loop()
+        server = sock = None
+        if self.protocol == 'udp':
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            address = (self.host, self.port)
+
+            def send(data):
+                try:
+                    sock.sendto(data, address)
+                except (BlockingIOError, ConnectionRefusedError):
+                    self.dropped += 1
+        else:
+            self.connected = asyncio.Event()
+            server = await asyncio.start_server(self.accept, self.host, self.port)
+            print(f"{self.name}: listening")
+            if self.wait_for_client:
+                await self.connected.wait()
+            send = self.broadcast
+
+        # Every fix has an absolute target time from the start of the replay, so sleeping late never adds up to drift,
+        # and fixes already due when a sleep ends are sent right away to catch up
+        num_fixes = len(self.time)
+        targets = (self.time - self.time[0]) / self.speedup
+        lateness = np.empty(num_fixes)
+        try:
+            start = loop.time()
+            for i in range(num_fixes):
+                delay = start + targets[i] - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                now = loop.time()
+                send(self.encode(i))
+                lateness[i] = now - start - targets[i]
+            end = loop.time()
+        finally:
+            if sock is not None:
+                sock.close()
+            if server is not None:
+                for writer in list(self.clients):
+                    writer.close()
+                server.close()
+        return self.report(num_fixes, end - start, lateness)
+
+    def report(self, num_fixes, duration, lateness):
+        report = {
+            'name': self.name,
+            'fixes': num_fixes,
+            'duration_s': duration,
+            'target_rate_hz': (num_fixes - 1) / (self.time[-1] - self.time[0]) * self.speedup,
+            'rate_hz': (num_fixes - 1) / duration if duration > 0 else float('inf'),
+            'jitter_p50_ms': float(np.percentile(lateness, 50)) * 1000,
+            'jitter_p95_ms': float(np.percentile(lateness, 95)) * 1000,
+            'jitter_max_ms': float(lateness.max()) * 1000,
+            'dropped': self.dropped,
+        }
+        print(f"{self.name}: {num_fixes} fixes in {duration:.2f} s, {report['rate_hz']:.1f} Hz "
+              f"(target {report['target_rate_hz']:.1f} Hz), late by p50 {report['jitter_p50_ms']:.2f} ms, "
+              f"p95 {report['jitter_p95_ms']:.2f} ms, max {report['jitter_max_ms']:.2f} ms, {self.dropped} dropped")
+        return report
+
+async def replay_all(streams):
+    return await asyncio.gather(*(stream.run() for stream in streams))
+
+def replay_streams(streams):
+    # Run many replays at once on one event loop, returns the report of every stream
+    return asyncio.run(replay_all(streams))
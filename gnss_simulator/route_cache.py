@@ -0,0 +1,31 @@
+import hashlib
+import json
+import sqlite3
+import threading
+
+class RouteCache:
+    def __init__(self, path="osrm_routes.sqlite"):
+        # Router responses kept on disk, so re-running a scenario never asks the router for the same route again
+        self.path = path
+        self.lock = threading.Lock()
+        # WAL lets processes sharing the file read while one of them writes
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, response TEXT)")
+
+    def key(self, router_url, profile, coordinates):
+        # coordinates: the "lon,lat;lon,lat;..." part of the request
+        return hashlib.sha1(f"{router_url}|{profile}|{coordinates}".encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM routes WHERE key=?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, response):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO routes VALUES (?, ?)", (key, json.dumps(response)))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+from scenario_runner import run_scenarios
+
+# Every ordered pair of these places, driven at two speeds and frequencies
+places = {
+    'sfo': [37.6130184, -122.39625356],  # near SF airport
+    'google': [37.4213068, -122.093090], # near Google
+    'sjc': [37.365739, -121.905370],     # near SJ airport
+    'meta': [37.482092, -122.150314],    # near Meta HQ
+}
+scenarios = [{'name': f"{start}_to_{end}_{speed}mps_{freq}hz", 'waypoints': [places[start], places[end]], 'speed': speed, 'freq': freq}
+             for start in places for end in places if start != end
+             for speed, freq in ((30, 10), (20, 5))]
+# Or a JSON manifest with the same scenarios: run_scenarios('scenarios.json', 'scenario_library')
+
+# Offline elevation from local SRTM tiles: run_scenarios(scenarios, 'scenario_library', dem_directory='srtm_tiles')
+# A local router and DEM need no request limit: run_scenarios(scenarios, 'scenario_library', router_url='http://localhost:5000',
+#                                                             dem_directory='srtm_tiles', host_rate=None)
+run_scenarios(scenarios, 'scenario_library')
@@ -0,0 +1,122 @@
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import requests
+from gnss_simulator import GnssSimulator, Waypoint
+from map_api_client import MapAPIClient, ROUTER_URL
+from dem_sampler import DemSampler
+from trajectory_parquet import TrajectoryWriter
+
+# A manifest is a JSON list of scenarios, speed (m/s) and freq (Hz) default to those of simulate_virtual_drive:
+# [{"name": "sfo_to_sjc", "waypoints": [[37.6130, -122.3962], [37.3657, -121.9053]], "speed": 30, "freq": 10}, ...]
+# Each drive is written to <output_dir>/scenario=<name>/part-0.parquet, a hive partitioned dataset
+# that pyarrow.dataset or pandas.read_parquet(output_dir) read back with a scenario column
+SCENARIO_NAME = re.compile(r'^[\w.-]+$')
+
+worker_simulator = None
+
+def load_manifest(manifest):
+    # manifest: path of a JSON manifest, or its list of scenarios
+    if isinstance(manifest, str):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    names = set()
+    for scenario in manifest:
+        name = scenario.get('name')
+        if name is None or not SCENARIO_NAME.match(name):
+            raise ValueError(f"Invalid scenario name {name!r}, use letters, digits, '_', '-' and '.' only.")
+        if name in names:
+            raise ValueError(f"Duplicate scenario name {name!r}.")
+        if len(scenario.get('waypoints', [])) < 2:
+            raise ValueError(f"Scenario {name!r} needs at least two waypoints.")
+        names.add(name)
+    return manifest
+
+def scenario_path(output_dir, name):
+    return os.path.join(output_dir, f"scenario={name}", "part-0.parquet")
+
+def init_worker(router_url, dem_directory, host_rate, workers_started, start_interval):
+    # One simulator per process, with its own connections to the shared route and tile caches
+    # host_rate: this worker's share of the batch's request budget per host
+    # Workers fetching elevations start start_interval (the batch-wide request interval) apart, so their requests
+    # interleave evenly instead of all going out at once; with a DEM they only hit the router for a route the
+    # prefetch missed, so they start right away
+    global worker_simulator
+    if dem_directory is None:
+        with workers_started.get_lock():
+            index = workers_started.value
+            workers_started.value += 1
+        time.sleep(index * start_interval)
+    elevation_sampler = DemSampler(dem_directory) if dem_directory is not None else None
+    map_api_obj = MapAPIClient(router_url=router_url, host_rate=host_rate, host_concurrency=1)
+    worker_simulator = GnssSimulator(elevation_sampler=elevation_sampler, map_api_obj=map_api_obj)
+
+def run_scenario(scenario, output_dir):
+    start_time = time.perf_counter()
+    try:
+        worker_simulator.add_waypoints([Waypoint(lat, lon) for lat, lon in scenario['waypoints']])
+        worker_simulator.calculate_route()
+        worker_simulator.simulate_virtual_drive(scenario.get('speed', 30), scenario.get('freq', 10))
+    except (ValueError, requests.RequestException) as e:
+        return {'name': scenario['name'], 'error': str(e), 'samples': 0, 'seconds': time.perf_counter() - start_time}
+
+    # Written under a temporary name first, so an interrupted batch never leaves a partial file behind
+    path = scenario_path(output_dir, scenario['name'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with TrajectoryWriter(path + '.tmp') as writer:
+        writer.write(worker_simulator.virtual_drive)
+    os.replace(path + '.tmp', path)
+    return {'name': scenario['name'], 'error': None, 'samples': len(worker_simulator.virtual_drive),
+            'seconds': time.perf_counter() - start_time}
+
+def run_scenarios(manifest, output_dir, workers=None, router_url=ROUTER_URL, dem_directory=None, overwrite=False, host_rate=1.0):
+    # Simulate every scenario of a manifest on a process pool, one Parquet partition per scenario
+    # dem_directory: local SRTM tiles for the elevations (see DemSampler), instead of the OpenTopoData API
+    # host_rate: requests per second allowed to each host (router, OpenTopoData) by the whole batch, split evenly
+    # between the workers; the public servers ask for at most one per second, None for no limit (e.g. a local router with a DEM)
+    # overwrite: simulate again the scenarios already in output_dir, by default they are skipped so a batch can be resumed
+    # Returns a summary with the result of every scenario run
+    scenarios = load_manifest(manifest)
+    workers = workers or os.cpu_count()
+    start_time = time.perf_counter()
+    stored = set() if overwrite else {scenario['name'] for scenario in scenarios if os.path.exists(scenario_path(output_dir, scenario['name']))}
+    pending = [scenario for scenario in scenarios if scenario['name'] not in stored]
+    print(f"Scenarios: {len(pending)} to simulate, {len(stored)} already in {output_dir}")
+
+    # Routes are fetched up front by threads sharing one rate limiter, the workers then find them in the route cache
+    try:
+        MapAPIClient(router_url=router_url, host_rate=host_rate).get_osrm_routes([[Waypoint(lat, lon) for lat, lon in scenario['waypoints']] for scenario in pending])
+    except (ValueError, requests.RequestException) as e:
+        print(f"WARNING: Prefetching the routes failed ({e}), the scenarios without a route are reported below.")
+
+    # Without a DEM the workers fetch elevations themselves, each one within its share of the budget
+    results = []
+    samples = 0
+    worker_rate = host_rate / workers if host_rate else None
+    start_interval = 1 / host_rate if host_rate else 0
+    initargs = (router_url, dem_directory, worker_rate, multiprocessing.Value('i', 0), start_interval)
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=initargs) as pool:
+        futures = [pool.submit(run_scenario, scenario, output_dir) for scenario in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            samples += result['samples']
+            elapsed = time.perf_counter() - start_time
+            status = f"FAILED: {result['error']}" if result['error'] else f"{result['samples']} samples in {result['seconds']:.2f} s"
+            print(f"[{len(results)}/{len(pending)}] {result['name']}: {status} ({len(results) / elapsed:.1f} scenarios/s)")
+
+    elapsed = time.perf_counter() - start_time
+    failed = [result['name'] for result in results if result['error']]
+    summary = {'scenarios': len(results) - len(failed), 'skipped': len(stored), 'failed': failed, 'samples': samples,
+               'seconds': elapsed, 'workers': workers, 'results': results}
+    print("#" * 20)
+    print("Batch Metrics:")
+    print(f"  - Scenarios simulated: {summary['scenarios']} ({len(stored)} already stored, {len(failed)} failed)")
+    print(f"  - Samples written: {samples}")
+    print(f"  - Duration: {elapsed:.2f} seconds on {workers} workers")
+    print(f"  - Throughput: {len(results) / elapsed:.2f} scenarios/s, {samples / elapsed:.0f} samples/s")
+    print("#" * 20)
+    return summary
@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class TileStore:
+    def __init__(self, path="osm_tiles.mbtiles", max_bytes=256 * 2**20):
+        # All tiles in one SQLite file with the MBTiles layout (https://github.com/mapbox/mbtiles-spec),
+        # instead of one PNG file per tile, plus an in-memory LRU of the decoded tiles
+        # max_bytes: budget of the decoded tiles kept in memory, the least recently used ones are dropped beyond it
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # WAL lets processes sharing the file read while one of them writes, the timeout lets a writer wait for another
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            # Files written before the unique index may hold the metadata twice, from processes racing to create it
+            self.connection.execute("DELETE FROM metadata WHERE rowid NOT IN (SELECT MIN(rowid) FROM metadata GROUP BY name)")
+            self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+            self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+            self.connection.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?)", [('name', 'osm_tiles'), ('format', 'png')])
+
+        self.images = OrderedDict()  # (zoom, xtile, ytile) -> decoded tile, most recently used last
+        self.image_bytes = 0
+        self.decode_count = 0
+
+    def tile_row(self, ytile, zoom):
+        # MBTiles numbers rows from the south (TMS), slippy map tiles from the north
+        return (1 << zoom) - 1 - ytile
+
+    def get(self, xtile, ytile, zoom):
+        # Encoded tile, or None if it is not stored
+        with self.lock:
+            row = self.connection.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                          (zoom, xtile, self.tile_row(ytile, zoom))).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, xtile, ytile, zoom, data):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", (zoom, xtile, self.tile_row(ytile, zoom), data))
+
+    def stored(self, min_x, max_x, min_y, max_y, zoom):
+        # (xtile, ytile) of the tiles already stored in a range, in one indexed query
+        with self.lock:
+            rows = self.connection.execute("SELECT tile_column, tile_row FROM tiles WHERE zoom_level=? AND tile_column BETWEEN ? AND ? "
+                                           "AND tile_row BETWEEN ? AND ?",
+                                           (zoom, min_x, max_x, self.tile_row(max_y, zoom), self.tile_row(min_y, zoom))).fetchall()
+        return {(xtile, self.tile_row(row, zoom)) for xtile, row in rows}
+
+    def get_image(self, xtile, ytile, zoom):
+        # Decoded tile from the LRU, or None; the image is shared, so callers must not modify it
+        key = (zoom, xtile, ytile)
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+        return image
+
+    def put_image(self, xtile, ytile, zoom, image):
+        key = (zoom, xtile, ytile)
+        nbytes = image.width * image.height * len(image.getbands())
+        with self.lock:
+            self.decode_count += 1
+            if key in self.images:
+                return
+            self.images[key] = image
+            self.image_bytes += nbytes
+            while self.image_bytes > self.max_bytes and len(self.images) > 1:
+                evicted = self.images.popitem(last=False)[1]
+                self.image_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+
+    def close(self):
+        self.connection.close()
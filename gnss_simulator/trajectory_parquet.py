@@ -0,0 +1,38 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Rows per row group, the unit readers can skip or load on their own (~2 MB of drive at 10 Hz)
+ROW_GROUP_SIZE = 65536
+
+def trajectory_table(trajectory):
+    # Arrow table with the virtual drive CSV columns, built on the trajectory arrays without copying them
+    return pa.table({column: getattr(trajectory, name) for name, column in trajectory.COLUMNS.items() if getattr(trajectory, name) is not None})
+
+class TrajectoryWriter:
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE):
+        # Parquet file of a trajectory written a row group at a time, so a drive never has to be in memory all at once
+        # Typed columns (float64 positions and time, float32 altitude and speed) instead of CSV text,
+        # byte stream split and zstd shrink smooth float columns about 4x compared to CSV
+        self.path = path
+        self.row_group_size = row_group_size
+        self.writer = None
+        self.num_rows = 0
+
+    def write(self, trajectory):
+        # Trajectories written one after the other are appended, they must all have the same columns
+        table = trajectory_table(trajectory)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression='zstd', use_dictionary=False,
+                                           use_byte_stream_split=True)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.num_rows += len(trajectory)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
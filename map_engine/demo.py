@@ -3,6 +3,19 @@
 from map_engine import MapEngine
 
 map_engine = MapEngine()
+# Offline alternative: build the road graph from a local OSM extract instead of the Overpass API
+# from map_source import PbfSource
+# map_engine = MapEngine(map_source=PbfSource('california-latest.osm.pbf'))
 map_engine.set_gnss_data('../gnss_simulator/demo_virtual_drive.csv')
+# Parquet drives load only the needed columns, e.g. every 10th sample of the first row groups:
+# map_engine.set_gnss_data('../gnss_simulator/demo_virtual_drive.parquet', stride=10, row_groups=[0, 1])
 map_engine.calculate_realtime_map()
-map_engine.plot_map()
\ No newline at end of file
+# Replays of a known drive: match it once to its route and slice every horizon out of that (index file reused across runs)
+# map_engine.calculate_realtime_map(corridor=map_engine.build_corridor('demo_virtual_drive.corridor.npz'))
+map_engine.plot_map()
+# For long drives, stream a lighter standalone page instead: map_engine.export_map('drive.html', every=2)
+
+# Streaming alternative: replay the drive as a live 10 Hz feed, one ego map per fix
+# from gnss_stream import read_gnss_csv, pace
+# for frame in map_engine.stream_realtime_map(pace(read_gnss_csv('../gnss_simulator/demo_virtual_drive.csv')), latency_budget=0.1):
+#     print(frame['timestamp_s'], f"{frame['latency_s'] * 1000:.1f} ms")
@@ -0,0 +1,49 @@
+import numpy as np
+import shapely
+from local_projection import LocalProjection, project_onto_segments
+
+class EdgeIndex:
+    def __init__(self, road_graph):
+        # Edge end points as contiguous arrays, one row per edge of the road graph
+        # The graph is fetched unsimplified, so every edge is a straight segment between its two nodes
+        self.road_graph = road_graph
+        self.start_latlon = np.column_stack((road_graph.node_lat[road_graph.edge_source], road_graph.node_lon[road_graph.edge_source]))
+        self.end_latlon = np.column_stack((road_graph.node_lat[road_graph.edge_target], road_graph.node_lon[road_graph.edge_target]))
+
+        # Project every node once into a local metric frame, matching then only needs plain vector arithmetic
+        if road_graph.num_nodes:
+            self.projection = LocalProjection.around(road_graph.node_lat, road_graph.node_lon)
+        else:
+            self.projection = LocalProjection(0.0, 0.0)
+        node_xy = self.projection.forward(road_graph.node_lat, road_graph.node_lon)
+        self.start_xy = node_xy[road_graph.edge_source]
+        self.end_xy = node_xy[road_graph.edge_target]
+
+        # Build the spatial index once, in meters so nearest edges are not skewed by shorter longitude degrees
+        self.tree = shapely.STRtree(shapely.linestrings(np.stack([self.start_xy, self.end_xy], axis=1)))
+
+    def match(self, latlongs):
+        # Match an array of [lat, lon] samples to their nearest edges in one vectorized call
+        latlongs = np.asarray(latlongs, dtype=np.float64).reshape(-1, 2)
+        xy = self.projection.forward(latlongs[:, 0], latlongs[:, 1])
+        sample_idx, edge_idx = self.tree.query_nearest(shapely.points(xy), all_matches=False)
+        nearest = np.empty(len(latlongs), dtype=np.int64)
+        nearest[sample_idx] = edge_idx
+
+        # Project each sample onto its edge in meters, clamped to the segment
+        A = self.start_xy[nearest]
+        B = self.end_xy[nearest]
+        t, poses = project_onto_segments(A, B, xy)
+
+        # Offsets in meters: along the edge to both end nodes, and across the edge to the GNSS sample
+        # The projection is affine, so the pose interpolates the edge in lat/lon with the same t
+        # The plane only gives t, the distances along the edge are shares of its great-circle length like the horizon
+        # uses, the plane's own distances stretch away from its center
+        edge_length = self.road_graph.edge_length[nearest].astype(np.float64)
+        return {
+            'edge': nearest,
+            'pose': self.start_latlon[nearest] + t[:, None] * (self.end_latlon[nearest] - self.start_latlon[nearest]),
+            'forward_dist': (1 - t) * edge_length,
+            'backward_dist': t * edge_length,
+            'lateral_offset': np.hypot(*(xy - poses).T),
+        }
@@ -0,0 +1,170 @@
+import mmap
+import struct
+import numpy as np
+from local_projection import COORDINATE_DTYPE
+
+# An ego frame is one ego map as flat arrays instead of lists of floats:
+#   'origin':  COORDINATE_DTYPE [lat, lon] the coordinates are relative to
+#   'coords':  float32 (n_points, 2) [lat, lon] of every point, minus the origin
+#   'offsets': int32 (n_segments + 1), the points of segment i are coords[offsets[i]:offsets[i + 1]]
+
+FILE_MAGIC = b'EGOF'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<4sI')  # magic, version
+RECORD_LENGTH = struct.Struct('<I')  # every frame is prefixed with its length in bytes
+FRAME_HEADER = struct.Struct('<ddIIII')  # origin lat, origin lon, kind, segments, new segments, new points
+KEY_FRAME = 0
+DELTA_FRAME = 1
+
+def make_frame(start_latlon, end_latlon, origin):
+    # Frame of straight segments from start_latlon[i] to end_latlon[i], both (n, 2) arrays of [lat, lon]
+    origin = np.asarray(origin, dtype=COORDINATE_DTYPE)
+    start_latlon = np.asarray(start_latlon, dtype=np.float64).reshape(-1, 2)
+    end_latlon = np.asarray(end_latlon, dtype=np.float64).reshape(-1, 2)
+    coords = np.empty((2 * len(start_latlon), 2), dtype=np.float32)
+    coords[0::2] = start_latlon - origin
+    coords[1::2] = end_latlon - origin
+    return {'origin': origin, 'coords': coords, 'offsets': np.arange(0, len(coords) + 1, 2, dtype=np.int32)}
+
+def empty_frame(origin):
+    return make_frame(np.empty((0, 2)), np.empty((0, 2)), origin)
+
+def frame_latlon(frame):
+    # Absolute [lat, lon] of every point of the frame, as COORDINATE_DTYPE
+    return frame['coords'] + frame['origin']
+
+def frame_to_map(frame):
+    # The frame as {'lat': [...], 'lon': [...]} lists with None between segments, e.g. for plotly
+    latlon = frame_latlon(frame)
+    segments = np.split(latlon, frame['offsets'][1:-1]) if len(frame['offsets']) > 1 else []
+    map = {'lat': [], 'lon': []}
+    for segment in segments:
+        map['lat'].extend(segment[:, 0].tolist() + [None])
+        map['lon'].extend(segment[:, 1].tolist() + [None])
+    return map
+
+class EgoFrameWriter:
+    def __init__(self, path, delta=True, keyframe_interval=50):
+        # Writes frames to a length-prefixed binary stream
+        # delta: store segments already present in the previous frame as a reference to it instead of their points
+        # keyframe_interval: write a full frame at least this often, so a reader can resync
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.previous = None  # (frame, {segment bytes: segment index}) of the last frame written
+        self.since_keyframe = 0
+        self.count = 0
+
+    def write(self, frame):
+        coords = np.ascontiguousarray(frame['coords'], dtype=np.float32)
+        offsets = np.ascontiguousarray(frame['offsets'], dtype=np.int32)
+        segments = [coords[start:end].tobytes() for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+        use_delta = (self.delta and self.previous is not None and self.since_keyframe < self.keyframe_interval
+                     and np.array_equal(self.previous[0]['origin'], frame['origin']))
+        if use_delta:
+            # Reuse whole segments of the previous frame, only new segments carry points
+            previous_segments = self.previous[1]
+            source = np.array([previous_segments.get(segment, -1) for segment in segments], dtype=np.int32)
+            new = np.flatnonzero(source < 0)
+            lengths = (offsets[1:] - offsets[:-1])[new]
+            new_offsets = np.zeros(len(new) + 1, dtype=np.int32)
+            np.cumsum(lengths, out=new_offsets[1:])
+            new_coords = coords[np.repeat(offsets[new], lengths) + np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1], lengths)]
+            arrays = (source, new_offsets, new_coords)
+            self.since_keyframe += 1
+        else:
+            new_offsets, new_coords = offsets, coords
+            arrays = (offsets, coords)
+            self.since_keyframe = 1
+
+        header = FRAME_HEADER.pack(frame['origin'][0], frame['origin'][1], DELTA_FRAME if use_delta else KEY_FRAME,
+                                   len(offsets) - 1, len(new_offsets) - 1, len(new_coords))
+        self.file.write(RECORD_LENGTH.pack(len(header) + sum(array.nbytes for array in arrays)))
+        self.file.write(header)
+        for array in arrays:
+            self.file.write(memoryview(array))  # straight from the array buffer, no intermediate bytes copy
+        self.previous = ({'origin': np.asarray(frame['origin']), 'coords': coords, 'offsets': offsets},
+                         {segment: i for i, segment in enumerate(segments)})
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class EgoFrameReader:
+    def __init__(self, path):
+        # Reads frames back from a memory-mapped stream file
+        # Key frames are returned as views into the mapped file without copying, delta frames are rebuilt from the previous frame
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.file.seek(0, 2) else b''
+        if len(self.buffer) < FILE_HEADER.size:
+            raise ValueError(f"{path} is not an ego frame file.")
+        magic, version = FILE_HEADER.unpack_from(self.buffer, 0)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError(f"{path} is not an ego frame file (version {FILE_VERSION}).")
+
+    def __iter__(self):
+        position = FILE_HEADER.size
+        previous = None
+        while position + RECORD_LENGTH.size <= len(self.buffer):
+            (length,) = RECORD_LENGTH.unpack_from(self.buffer, position)
+            position += RECORD_LENGTH.size
+            if position + length > len(self.buffer):
+                break  # frame cut off by a writer that is still running or was killed
+            frame = self.read_frame(position, previous)
+            position += length
+            previous = frame
+            yield frame
+
+    def read_frame(self, position, previous):
+        origin_lat, origin_lon, kind, num_segments, num_new_segments, num_points = FRAME_HEADER.unpack_from(self.buffer, position)
+        position += FRAME_HEADER.size
+        source = None
+        if kind == DELTA_FRAME:
+            if previous is None:
+                raise ValueError("Delta frame without a preceding key frame.")
+            source = np.frombuffer(self.buffer, dtype=np.int32, count=num_segments, offset=position)
+            position += source.nbytes
+        offsets = np.frombuffer(self.buffer, dtype=np.int32, count=num_new_segments + 1, offset=position)
+        position += offsets.nbytes
+        coords = np.frombuffer(self.buffer, dtype=np.float32, count=2 * num_points, offset=position).reshape(-1, 2)
+        origin = np.array([origin_lat, origin_lon])
+        if source is None:
+            return {'origin': origin, 'coords': coords, 'offsets': offsets}
+
+        # Gather every segment from the previous frame's points or from the new points, in frame order
+        pool = np.concatenate((previous['coords'], coords))
+        previous_lengths = np.diff(previous['offsets'])
+        new_lengths = np.diff(offsets)
+        reused = source >= 0
+        starts = np.empty(num_segments, dtype=np.int64)
+        lengths = np.empty(num_segments, dtype=np.int64)
+        starts[reused] = previous['offsets'][source[reused]]
+        lengths[reused] = previous_lengths[source[reused]]
+        starts[~reused] = len(previous['coords']) + offsets[:-1]
+        lengths[~reused] = new_lengths
+        frame_offsets = np.zeros(num_segments + 1, dtype=np.int32)
+        np.cumsum(lengths, out=frame_offsets[1:])
+        points = np.repeat(starts - frame_offsets[:-1], lengths) + np.arange(frame_offsets[-1])
+        return {'origin': origin, 'coords': pool[points], 'offsets': frame_offsets}
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.close()
+            except BufferError:
+                pass  # frames handed out still view the mapping, it is released once they are gone
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+import asyncio
+from map_engine import MapEngine
+from fleet_service import FleetService, replay_fleet
+
+# One road graph for the whole fleet, loaded around the demo drive
+drive = '../gnss_simulator/demo_virtual_drive.csv'
+map_engine = MapEngine()
+map_engine.set_gnss_data(drive)
+service = FleetService(map_engine)
+
+async def main():
+    # Serve and replay ten vehicles over a local socket, 20 times faster than real time
+    server = await service.start('127.0.0.1', 8765)
+    async with server:
+        await replay_fleet('127.0.0.1', 8765, {f'vehicle-{i}': drive for i in range(10)}, speedup=20)
+    service.stats.report()
+
+asyncio.run(main())
@@ -0,0 +1,136 @@
+import asyncio
+import copy
+import json
+import math
+import time
+import numpy as np
+from horizon import IncrementalHorizon
+from latency_stats import LatencyStats, ego_graph_nbytes
+from gnss_stream import read_gnss_csv
+from scheduler import step_distance
+
+class VehicleState:
+    def __init__(self, road_graph, scheduler, origin):
+        # Everything kept per vehicle: its incremental horizon, update schedule and odometer
+        self.horizon = IncrementalHorizon(road_graph)
+        self.scheduler = copy.copy(scheduler)
+        self.scheduler.reset()
+        self.origin = origin
+        self.distance = 0.0
+        self.previous_latlong = None
+        self.ego_graph = None
+        self.last_seen = time.monotonic()
+
+class FleetService:
+    def __init__(self, map_engine, idle_timeout=60):
+        # Serves horizons for many vehicles from one process, all sharing the road graph and edge index of map_engine
+        # idle_timeout: seconds without a fix after which a vehicle's state is dropped
+        if map_engine.road_graph is None:
+            raise ValueError("No road graph loaded. Please call load_road_graph() before starting the fleet service.")
+        self.map_engine = map_engine
+        self.idle_timeout = idle_timeout
+        self.vehicles = {}
+        self.stats = LatencyStats()
+
+    def update(self, vehicle_id, timestamp, lat, lon):
+        # Advance one vehicle to a new fix and return the reply
+        # The ego frame is only sent when the scheduler recomputed the horizon, otherwise the vehicle keeps its last one
+        # NaN or infinite values would go through the search and end up as bare NaN in the reply, which is not valid JSON
+        if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f"Coordinates out of range: {lat}, {lon}")
+        if timestamp is not None and not (isinstance(timestamp, (int, float)) and math.isfinite(timestamp)):
+            raise ValueError(f"Timestamp must be a finite number: {timestamp}")
+        start_time = time.perf_counter()
+        vehicle = self.vehicles.get(vehicle_id)
+        if vehicle is None:
+            vehicle = self.vehicles[vehicle_id] = VehicleState(self.map_engine.road_graph, self.map_engine.scheduler, [lat, lon])
+        vehicle.last_seen = time.monotonic()
+        if vehicle.previous_latlong is not None:
+            vehicle.distance += float(step_distance(vehicle.previous_latlong[0], vehicle.previous_latlong[1], lat, lon))
+        vehicle.previous_latlong = (lat, lon)
+
+        match = self.map_engine.edge_index.match([(lat, lon)])
+        match_time = time.perf_counter()
+        reply = {'vehicle': vehicle_id, 'timestamp_s': timestamp, 'updated': False}
+        horizon_time = convert_time = match_time
+        if vehicle.scheduler.due(vehicle.distance, int(match['edge'][0])):
+            vehicle.ego_graph = vehicle.horizon.update(match['edge'][0], match['forward_dist'][0], match['backward_dist'][0])
+            horizon_time = time.perf_counter()
+            frame = self.map_engine.ego_graph_to_frame(vehicle.ego_graph, vehicle.origin)
+            convert_time = time.perf_counter()
+            reply.update(updated=True, origin=frame['origin'].tolist(), coords=frame['coords'].ravel().astype(np.float64).round(7).tolist(),
+                         offsets=frame['offsets'].tolist())
+            self.stats.add_tick(len(self.stats.ticks), match_time - start_time, horizon_time - match_time, convert_time - horizon_time,
+                                len(vehicle.ego_graph['edge']), ego_graph_nbytes(vehicle.ego_graph, frame))
+        return reply
+
+    async def handle(self, reader, writer):
+        # One connection can carry any number of vehicles, as newline-delimited JSON:
+        # {"vehicle": "car-1", "timestamp_s": 0.0, "lat": 37.6, "lon": -122.4} in, one JSON reply per line out
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                reply = self.update(request['vehicle'], request.get('timestamp_s'), float(request['lat']), float(request['lon']))
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': f"Bad request: {e}"}
+            writer.write((json.dumps(reply) + '\n').encode())
+            await writer.drain()
+        writer.close()
+
+    async def evict_idle_vehicles(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            for vehicle_id in [vehicle_id for vehicle_id, vehicle in self.vehicles.items() if now - vehicle.last_seen > self.idle_timeout]:
+                del self.vehicles[vehicle_id]
+
+    async def start(self, host='127.0.0.1', port=8765):
+        # Start listening and return the asyncio server, e.g. to run a client in the same event loop
+        server = await asyncio.start_server(self.handle, host, port)
+        self.evictor = asyncio.create_task(self.evict_idle_vehicles())
+        print(f"Fleet service listening on {host}:{port} with a road graph of {self.map_engine.road_graph.num_edges} edges.")
+        return server
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+async def replay_drive(host, port, vehicle_id, path, speedup=1.0):
+    # Stand-in vehicle: send the fixes of a drive CSV at their recorded rate (divided by speedup) and time the replies
+    reader, writer = await asyncio.open_connection(host, port)
+    loop = asyncio.get_running_loop()
+    start = None
+    round_trips, updates = [], 0
+    for timestamp, lat, lon in read_gnss_csv(path):
+        if start is None:
+            start = (loop.time(), timestamp)
+        delay = start[0] + (timestamp - start[1]) / speedup - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent = time.perf_counter()
+        writer.write((json.dumps({'vehicle': vehicle_id, 'timestamp_s': timestamp, 'lat': lat, 'lon': lon}) + '\n').encode())
+        await writer.drain()
+        reply = json.loads(await reader.readline())
+        round_trips.append(time.perf_counter() - sent)
+        if 'error' in reply:
+            raise ValueError(f"{vehicle_id}: {reply['error']}")
+        updates += reply['updated']
+    writer.close()
+    await writer.wait_closed()
+    return {'vehicle': vehicle_id, 'fixes': len(round_trips), 'updates': updates,
+            'p50_ms': float(np.percentile(round_trips, 50)) * 1000, 'p95_ms': float(np.percentile(round_trips, 95)) * 1000}
+
+async def replay_fleet(host, port, drives, speedup=1.0):
+    # Replay several drives at once, drives: {vehicle id: CSV path}
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(replay_drive(host, port, vehicle_id, path, speedup) for vehicle_id, path in drives.items()))
+    elapsed = time.perf_counter() - start_time
+    for result in results:
+        print(f"{result['vehicle']}: {result['fixes']} fixes, {result['updates']} horizon updates, "
+              f"round trip p50 {result['p50_ms']:.2f} ms, p95 {result['p95_ms']:.2f} ms")
+    print(f"Replayed {len(results)} vehicles, {sum(result['fixes'] for result in results) / elapsed:.0f} fixes/s in total.")
+    return results
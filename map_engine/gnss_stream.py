@@ -0,0 +1,134 @@
+import csv
+import socket
+import threading
+import time
+import types
+from collections import deque
+import numpy as np
+import pyarrow.parquet as pq
+
+# Columns of a drive (CSV or Parquet) the map engine reads, the others are never parsed
+GNSS_COLUMNS = ['timestamp_s', 'latitude_deg', 'longitude_deg']
+
+class FixBuffer:
+    def __init__(self, fixes, max_backlog=100):
+        # Reads fixes on a background thread, so a slow consumer never stalls the feed
+        # Only the newest max_backlog fixes are kept, older ones are overwritten
+        self.backlog = deque(maxlen=max_backlog)
+        self.condition = threading.Condition()
+        self.finished = False
+        self.error = None
+        self.overflow = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.read, args=(fixes,), daemon=True)
+        self.thread.start()
+
+    def read(self, fixes):
+        try:
+            for fix in fixes:
+                with self.condition:
+                    if self.stopped.is_set():
+                        break
+                    if len(self.backlog) == self.backlog.maxlen:
+                        self.overflow += 1
+                    self.backlog.append((time.perf_counter(), fix))
+                    self.condition.notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            # A generator source (e.g. read_gnss_socket) closes its file or socket here, on the thread running it
+            if isinstance(fixes, types.GeneratorType):
+                fixes.close()
+            with self.condition:
+                self.finished = True
+                self.condition.notify()
+
+    def take(self):
+        # Wait for fixes, then return all queued (arrival time, fix) pairs, oldest first
+        # An empty list means the source is exhausted
+        with self.condition:
+            while not self.backlog and not self.finished:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            fixes = list(self.backlog)
+            self.backlog.clear()
+            return fixes
+
+    def close(self):
+        # Stop reading at the next fix and drop the backlog, take() returns an empty list from now on
+        # The reader only notices once its source yields again, it is a daemon thread so it never blocks the exit
+        self.stopped.set()
+        with self.condition:
+            self.finished = True
+            self.backlog.clear()
+            self.condition.notify_all()
+
+def parse_gnss_line(line):
+    # Parse a "timestamp_s,latitude_deg,longitude_deg,..." CSV line, returns None for headers and garbage
+    if isinstance(line, bytes):
+        line = line.decode('ascii', errors='ignore')
+    fields = line.strip().split(',')
+    try:
+        return float(fields[0]), float(fields[1]), float(fields[2])
+    except (ValueError, IndexError):
+        return None
+
+def read_gnss_socket(host, port, protocol='udp'):
+    # Yield (timestamp_s, latitude_deg, longitude_deg) fixes sent as CSV lines
+    # UDP: listen on host:port for datagrams; TCP: connect to a publisher on host:port and read its stream
+    if protocol == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        lines = (line for datagram in iter(lambda: sock.recv(65535), b'') for line in datagram.splitlines())
+    elif protocol == 'tcp':
+        sock = socket.create_connection((host, port))
+        lines = sock.makefile('rb')
+    else:
+        raise ValueError("Protocol must be 'udp' or 'tcp'.")
+
+    with sock:
+        for line in lines:
+            fix = parse_gnss_line(line)
+            if fix is not None:
+                yield fix
+
+def read_gnss_csv(path):
+    # Yield (timestamp_s, latitude_deg, longitude_deg) fixes from a drive CSV one row at a time
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            yield float(row['timestamp_s']), float(row['latitude_deg']), float(row['longitude_deg'])
+
+def pace(fixes, speedup=1.0):
+    # Release fixes at their recorded timestamps (divided by speedup), to replay a log like a live feed
+    start = None
+    for fix in fixes:
+        if start is None:
+            start = (time.perf_counter(), fix[0])
+        delay = start[0] + (fix[0] - start[1]) / speedup - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield fix
+
+def load_gnss_parquet(path, stride=1, row_groups=None):
+    # Time and position columns of a Parquet drive, as a dict of arrays keyed by column
+    # Only the selected row groups (all by default) are read, one at a time, and only every stride-th sample of the
+    # drive is kept from each, so a long log never has to be in memory all at once
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    group_sizes = [metadata.row_group(group).num_rows for group in range(metadata.num_row_groups)]
+    group_offsets = np.concatenate(([0], np.cumsum(group_sizes)))
+    row_groups = range(metadata.num_row_groups) if row_groups is None else row_groups
+    if len(row_groups) == 0:
+        raise ValueError("No row group selected.")
+
+    chunks = {column: [] for column in GNSS_COLUMNS}
+    for group in row_groups:
+        if not 0 <= group < metadata.num_row_groups:
+            raise ValueError(f"Row group {group} out of range, {path} has {metadata.num_row_groups}.")
+        table = parquet_file.read_row_group(group, columns=GNSS_COLUMNS)
+        # The kept samples are the multiples of stride in the whole drive, whichever row group they fall in
+        rows = np.arange(-group_offsets[group] % stride, table.num_rows, stride)
+        for column in GNSS_COLUMNS:
+            chunks[column].append(table.column(column).to_numpy()[rows])
+    return {column: np.concatenate(chunks[column]) for column in GNSS_COLUMNS}
@@ -0,0 +1,69 @@
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+from road_graph import RoadGraph
+
+class GraphCache:
+    def __init__(self, cache_path="graph_cache"):
+        # Road graphs are stored as memory-mappable .npy arrays, one directory per fetch
+        # The directory name is a hash of the fetch parameters, index.json lists what each one covers
+        self.cache_path = cache_path
+        os.makedirs(self.cache_path, exist_ok=True)
+        self.index_path = os.path.join(self.cache_path, "index.json")
+        self.lock = threading.Lock()  # map tiles are fetched and stored from background threads
+
+    def key(self, bounding_box, **options):
+        # Content address of a fetch: the bounding box (rounded to ~0.1 m) and every option that changes the graph
+        request = {'bbox': [round(bounding_box[side], 6) for side in ('left', 'bottom', 'right', 'top')], **options}
+        return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def lookup(self, bounding_box, **options):
+        # Return the cached road graph for the request, or for any cached bounding box that covers it
+        index = self.read_index()
+        key = self.key(bounding_box, **options)
+        exact = key in index
+        if not exact:
+            covering = [entry for entry, info in index.items() if info['options'] == options and self.covers(info['bbox'], bounding_box)]
+            if not covering:
+                return None
+            # The smallest covering graph has the fewest roads to index
+            key = min(covering, key=lambda entry: self.area(index[entry]['bbox']))
+        path = os.path.join(self.cache_path, key)
+        if not os.path.isdir(path):
+            return None
+        # A covering graph is clipped to the request, so e.g. a map tile never holds the whole drive's graph
+        road_graph = RoadGraph.load(path)
+        return road_graph if exact else road_graph.clip(bounding_box)
+
+    def store(self, road_graph, bounding_box, **options):
+        # Write to a temporary directory first, so an interrupted run never leaves a half written graph behind
+        key = self.key(bounding_box, **options)
+        path = os.path.join(self.cache_path, key)
+        temporary_path = tempfile.mkdtemp(dir=self.cache_path)
+        road_graph.save(temporary_path)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(temporary_path, path)
+
+        with self.lock:
+            index = self.read_index()
+            index[key] = {'bbox': dict(bounding_box), 'options': options}
+            temporary_index = self.index_path + ".tmp"
+            with open(temporary_index, "w") as f:
+                json.dump(index, f, indent=2)
+            os.replace(temporary_index, self.index_path)
+
+    def covers(self, outer, inner):
+        return (outer['left'] <= inner['left'] and outer['bottom'] <= inner['bottom'] and
+                outer['right'] >= inner['right'] and outer['top'] >= inner['top'])
+
+    def area(self, bounding_box):
+        return (bounding_box['right'] - bounding_box['left']) * (bounding_box['top'] - bounding_box['bottom'])
@@ -0,0 +1,280 @@
+import heapq
+import numpy as np
+
+FORWARD_DISTANCE_THRESHOLD = 1000  # meters
+BACKWARD_DISTANCE_THRESHOLD = 250
+REVERSE_TOLERANCE = 5  # meters the vehicle may drift back on its edge (GNSS noise) before a rebuild
+SHORTCUT_TOLERANCE = 0.01  # meters a new path must save before an expanded node is moved to it
+
+class HorizonSearch:
+    def __init__(self, road_graph, direction, threshold):
+        # One direction of the horizon: a bounded Dijkstra search over the road graph, run lazily as the vehicle moves
+        # Node keys are positions on the vehicle odometer, so moving the vehicle never touches them
+        # The forward search follows out-edges and its keys grow ahead of the vehicle,
+        # the backward search follows in-edges and its keys shrink behind it
+        self.road_graph = road_graph
+        self.direction = direction
+        self.sign = 1 if direction == 'forward' else -1
+        self.threshold = threshold
+        if direction == 'forward':
+            self.offsets = road_graph.out_offsets
+            self.edges = None
+            self.neighbors = road_graph.edge_target
+            self.reverse_offsets = road_graph.in_offsets
+            self.reverse_edges = road_graph.in_edges
+            self.reverse_neighbors = road_graph.edge_source
+        else:
+            self.offsets = road_graph.in_offsets
+            self.edges = road_graph.in_edges
+            self.neighbors = road_graph.edge_source
+            self.reverse_offsets = road_graph.out_offsets
+            self.reverse_edges = None
+            self.reverse_neighbors = road_graph.edge_target
+        self.reset()
+
+    def reset(self):
+        # Expanded nodes carry their shortest distance, pending nodes a tentative one
+        # Nodes hang from the node they were reached through, so a whole branch can be evicted at once
+        self.key = {}
+        self.parent = {}
+        self.children = {}
+        self.expanded = set()
+        self.heap = []  # (sign * key, node) of pending nodes, nearest first
+        self.evict_heap = []  # (-sign * key, node) of expanded nodes, farthest first
+
+    def adjacent(self, node, reverse=False):
+        # Edge indices and neighbor nodes one step away in the search direction (or against it)
+        offsets = self.reverse_offsets if reverse else self.offsets
+        edges = self.reverse_edges if reverse else self.edges
+        neighbors = self.reverse_neighbors if reverse else self.neighbors
+        start, end = offsets[node], offsets[node + 1]
+        if edges is None:
+            return slice(start, end), neighbors[start:end]
+        edge_ids = edges[start:end]
+        return edge_ids, neighbors[edge_ids]
+
+    def add_node(self, node, key, parent):
+        self.key[node] = key
+        self.parent[node] = parent
+        self.children[node] = set()
+        if parent is not None:
+            self.children[parent].add(node)
+        heapq.heappush(self.heap, (self.sign * key, node))
+
+    def relax(self, node, key, parent):
+        # Dijkstra relaxation: add the node, or move it under a parent that gives a shorter path
+        if node not in self.key:
+            self.add_node(node, key, parent)
+            return
+        if self.parent[node] is None:
+            return
+        tolerance = SHORTCUT_TOLERANCE if node in self.expanded else 0
+        if self.sign * (key - self.key[node]) >= -tolerance:
+            return
+        self.children[self.parent[node]].discard(node)
+        self.parent[node] = parent
+        self.children[parent].add(node)
+        self.shift(node, key - self.key[node])
+
+    def shift(self, node, offset):
+        # Everything hanging from the node moves with it and has to relax its neighbors again
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            stack.extend(self.children[current])
+            self.key[current] += offset
+            self.expanded.discard(current)
+            heapq.heappush(self.heap, (self.sign * self.key[current], current))
+
+    def make_root(self, node, key):
+        # Root the search at the node, keeping whatever already hangs from it
+        if node not in self.key:
+            self.add_node(node, key, None)
+            return
+        if self.parent[node] is not None:
+            self.children[self.parent[node]].discard(node)
+            self.parent[node] = None
+        self.shift(node, key - self.key[node])
+
+    def attach(self, node, parent):
+        # Hang an existing root from a new root
+        self.parent[node] = parent
+        self.children[parent].add(node)
+
+    def expand(self, odometer):
+        # Expand nearest first and stop at the threshold
+        edge_length = self.road_graph.edge_length
+        while self.heap and self.heap[0][0] - self.sign * odometer < self.threshold:
+            key, node = heapq.heappop(self.heap)
+            key = self.sign * key
+            if self.key.get(node) != key or node in self.expanded:
+                continue
+            self.expanded.add(node)
+            if self.sign < 0:
+                # Only nodes behind the vehicle can fall out of the horizon later
+                heapq.heappush(self.evict_heap, (-self.sign * key, node))
+            edge_ids, neighbors = self.adjacent(node)
+            for neighbor, length in zip(neighbors.tolist(), edge_length[edge_ids].tolist()):
+                self.relax(neighbor, key + self.sign * length, node)
+
+        # Pending nodes behind the vehicle are never reached, so drop stale entries once they pile up
+        if len(self.heap) > 2 * len(self.key) + 64:
+            self.heap = [(self.sign * key, node) for node, key in self.key.items() if node not in self.expanded]
+            heapq.heapify(self.heap)
+
+    def evict(self, odometer):
+        # Drop everything hanging from nodes that fell out of the threshold (only happens behind the vehicle)
+        while self.evict_heap and -self.evict_heap[0][0] - self.sign * odometer >= self.threshold:
+            key, node = heapq.heappop(self.evict_heap)
+            key = -self.sign * key
+            if self.key.get(node) != key or node not in self.expanded:
+                continue
+            self.expanded.discard(node)
+            for child in list(self.children[node]):
+                self.prune(child)
+            # The node itself stays pending, so drifting back within REVERSE_TOLERANCE expands it again
+            heapq.heappush(self.heap, (self.sign * key, node))
+
+    def prune(self, node):
+        # Remove a node and its whole branch from the search
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            stack.extend(self.children.pop(current))
+            parent = self.parent.pop(current)
+            if parent in self.children:
+                self.children[parent].discard(current)
+            del self.key[current]
+            self.expanded.discard(current)
+
+            # Expanded nodes that also lead here must relax their edges again, it may still be reachable through them
+            for neighbor in self.adjacent(current, reverse=True)[1].tolist():
+                if neighbor in self.expanded:
+                    self.expanded.discard(neighbor)
+                    heapq.heappush(self.heap, (self.sign * self.key[neighbor], neighbor))
+
+    def expanded_ranges(self):
+        # Edges leaving all expanded nodes in the search direction, with the key of the node each one leaves from
+        nodes = np.fromiter(self.expanded, dtype=np.int64, count=len(self.expanded))
+        keys = np.array([self.key[node] for node in nodes.tolist()], dtype=np.float64)
+        counts = self.offsets[nodes + 1] - self.offsets[nodes]
+        positions = np.arange(counts.sum(), dtype=np.int64) + np.repeat(self.offsets[nodes] - np.cumsum(counts) + counts, counts)
+        edge_ids = positions if self.edges is None else self.edges[positions].astype(np.int64)
+        return edge_ids, np.repeat(keys, counts)
+
+class IncrementalHorizon:
+    def __init__(self, road_graph, forward_threshold=FORWARD_DISTANCE_THRESHOLD, backward_threshold=BACKWARD_DISTANCE_THRESHOLD):
+        # The horizon is kept between ticks as two searches sharing one odometer
+        self.road_graph = road_graph
+        self.forward = HorizonSearch(road_graph, 'forward', forward_threshold)
+        self.backward = HorizonSearch(road_graph, 'backward', backward_threshold)
+        self.odometer = 0.0
+        self.ego_edge = None
+        self.rebuild_count = 0
+
+    def update(self, ego_edge, forward_node_dist, backward_node_dist):
+        # Advance the horizon to the new map match, rebuilding only on a jump or a lost match
+        ego_edge = int(ego_edge)
+        if self.ego_edge is None:
+            self.rebuild(ego_edge, forward_node_dist, backward_node_dist)
+        elif ego_edge == self.ego_edge:
+            odometer = self.forward.key[self.target(ego_edge)] - forward_node_dist
+            if odometer < self.odometer - REVERSE_TOLERANCE:
+                self.rebuild(ego_edge, forward_node_dist, backward_node_dist)
+            else:
+                self.odometer = odometer
+        elif self.is_ahead(ego_edge):
+            self.odometer = self.forward.key[self.target(ego_edge)] - forward_node_dist
+            self.advance(ego_edge)
+        else:
+            self.rebuild(ego_edge, forward_node_dist, backward_node_dist)
+
+        # Evicting first lets nodes that reached the evicted ones through another path expand again
+        self.forward.expand(self.odometer)
+        self.backward.evict(self.odometer)
+        self.backward.expand(self.odometer)
+        return self.edges()
+
+    def source(self, edge):
+        return int(self.road_graph.edge_source[edge])
+
+    def target(self, edge):
+        return int(self.road_graph.edge_target[edge])
+
+    def rebuild(self, ego_edge, forward_node_dist, backward_node_dist):
+        self.rebuild_count += 1
+        self.ego_edge = ego_edge
+        self.odometer = 0.0
+        self.forward.reset()
+        self.backward.reset()
+
+        # Seed both searches from the ends of the ego edge
+        self.forward.add_node(self.target(ego_edge), forward_node_dist, None)
+        self.backward.add_node(self.source(ego_edge), -backward_node_dist, None)
+
+    def is_ahead(self, ego_edge):
+        # The new ego edge continues the current one if it lies on the shortest-path tree ahead
+        target = self.target(ego_edge)
+        return target in self.forward.key and self.forward.parent[target] == self.source(ego_edge)
+
+    def advance(self, ego_edge):
+        # Walk from the current forward root to the new ego edge, crossing every node in between
+        path = [self.source(ego_edge)]
+        while self.forward.parent[path[-1]] is not None:
+            path.append(self.forward.parent[path[-1]])
+        path.reverse()
+
+        previous = self.source(self.ego_edge)
+        for i, node in enumerate(path):
+            following = path[i + 1] if i + 1 < len(path) else self.target(ego_edge)
+            self.cross(node, previous, following)
+            previous = node
+        self.ego_edge = ego_edge
+
+    def cross(self, node, previous, following):
+        # Ahead: the next node becomes the forward root, the branches not taken here are evicted
+        key = self.forward.key[node]
+        self.forward.children[node].discard(following)
+        self.forward.parent[following] = None
+        self.forward.prune(node)
+
+        # Behind: the crossed node becomes the backward root, carrying the previous root behind it
+        # Expanding it again adds the roads merging in here and shortens backward paths through them
+        self.backward.make_root(node, key)
+        if self.odometer - key < self.backward.threshold:
+            self.backward.attach(previous, node)
+        else:
+            self.backward.prune(previous)
+
+    def edges(self):
+        # The horizon as edge indices into the road graph, ego edge first, with the part of each edge inside the
+        # horizon given as start and end fractions along the edge
+        ego_start = self.backward.key[self.source(self.ego_edge)]
+        ego_length = max(float(self.road_graph.edge_length[self.ego_edge]), 1e-9)
+        ego_from = min(max((self.odometer - self.backward.threshold - ego_start) / ego_length, 0), 1)
+        ego_to = min(max((self.odometer + self.forward.threshold - ego_start) / ego_length, 0), 1)
+
+        # Out-edges of forward nodes are clipped at the forward threshold, in-edges of backward nodes at the backward one
+        forward_edges, forward_keys = self.forward.expanded_ranges()
+        forward_to = self.clip(self.odometer + self.forward.threshold - forward_keys, forward_edges)
+        backward_edges, backward_keys = self.backward.expanded_ranges()
+        backward_from = 1 - self.clip(backward_keys - self.odometer + self.backward.threshold, backward_edges)
+
+        # After the vehicle drifted back, nodes expanded earlier can lie past the threshold and clip their edges to nothing,
+        # those are dropped first so they never hide the same edge found in the other direction
+        edges = np.concatenate(([self.ego_edge], forward_edges, backward_edges))
+        start = np.concatenate(([ego_from], np.zeros(len(forward_edges)), backward_from))
+        end = np.concatenate(([ego_to], forward_to, np.ones(len(backward_edges))))
+        keep = end > start
+        keep[0] = True
+        edges, start, end = edges[keep], start[keep], end[keep]
+
+        # An edge found in both directions (a loop) is kept once
+        unique = np.sort(np.unique(edges, return_index=True)[1])
+        return {'edge': edges[unique], 'start': start[unique], 'end': end[unique]}
+
+    def clip(self, remaining, edges):
+        # Fraction of each edge that fits in the remaining distance
+        lengths = self.road_graph.edge_length[edges].astype(np.float64)
+        fraction = np.divide(remaining, lengths, out=np.ones(len(edges)), where=lengths > 0)
+        return np.clip(fraction, 0, 1)
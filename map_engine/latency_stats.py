@@ -0,0 +1,113 @@
+import csv
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+REALTIME_BUDGET = 0.1  # seconds per tick at 10 Hz
+STAGES = ('match', 'horizon', 'convert', 'total', 'latency')
+SIZES = ('edges', 'bytes')
+PERCENTILES = (50, 95, 99)
+
+class LatencyStats:
+    def __init__(self, budget=REALTIME_BUDGET, callback=None):
+        # Per-tick timings of the map engine stages in seconds, with the size of every ego map
+        # budget: real-time budget per tick in seconds
+        # callback: called with every tick record as it is added, e.g. to feed a live dashboard
+        self.budget = budget
+        self.callback = callback
+        self.ticks = []
+
+    def add_tick(self, index, match, horizon, convert, edges, nbytes, latency=None):
+        # index: sample index, match/horizon/convert: seconds spent in each stage
+        # edges: edges in the ego graph, nbytes: memory of the ego graph and its frame
+        # latency: seconds from the arrival of the fix to its ego map, when streaming
+        tick = {'index': index, 'match': match, 'horizon': horizon, 'convert': convert,
+                'total': match + horizon + convert, 'edges': edges, 'bytes': nbytes}
+        if latency is not None:
+            tick['latency'] = latency
+        self.add(tick)
+
+    def add(self, tick):
+        self.ticks.append(tick)
+        if self.callback is not None:
+            self.callback(tick)
+
+    def merge(self, other):
+        # Take over the ticks recorded by another instance, e.g. in a worker process
+        for tick in other.ticks:
+            self.add(tick)
+
+    def column(self, name):
+        return np.array([tick[name] for tick in self.ticks if name in tick], dtype=np.float64)
+
+    def summary(self):
+        # {stage or size: {'count', 'mean', 'p50', 'p95', 'p99', 'max'}} plus the number of ticks over budget
+        summary = {}
+        for name in STAGES + SIZES:
+            values = self.column(name)
+            if len(values):
+                summary[name] = {'count': len(values), 'mean': float(values.mean()),
+                                 **{f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}, 'max': float(values.max())}
+        timed = 'latency' if 'latency' in summary else 'total'
+        summary['over_budget'] = int((self.column(timed) > self.budget).sum())
+        return summary
+
+    def histogram(self, name='total', bins=20):
+        # Counts and bin edges of one stage (seconds) or size
+        return np.histogram(self.column(name), bins=bins)
+
+    def report(self):
+        summary = self.summary()
+        print(f"{'stage':>10} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+        for name in STAGES + SIZES:
+            if name not in summary:
+                continue
+            row = summary[name]
+            scale, unit = (1000, 'ms') if name in STAGES else ((1, '') if name == 'edges' else (1 / 1024, 'kB'))
+            print(f"{name:>10} {row['count']:>7} " + ' '.join(f"{row[key] * scale:>7.2f}{unit:<2}" for key in ('mean', 'p50', 'p95', 'p99', 'max')))
+        print(f"{summary['over_budget']} of {len(self.ticks)} ticks over the {self.budget * 1000:.0f} ms budget.")
+
+    def to_csv(self, path):
+        # One row per tick, for offline analysis
+        fields = ['index', 'match', 'horizon', 'convert', 'total', 'edges', 'bytes'] + (['latency'] if any('latency' in tick for tick in self.ticks) else [])
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.ticks)
+
+def ego_graph_nbytes(ego_graph, frame):
+    # Memory held by one tick: the horizon arrays and the ego frame built from them
+    return sum(value.nbytes for value in ego_graph.values()) + frame['coords'].nbytes + frame['offsets'].nbytes
+
+@contextmanager
+def profiling(kind=None, top=20):
+    # Opt-in profiling of a block of code
+    # kind: None (off), 'cprofile' for the top functions by cumulative time, 'tracemalloc' for the top allocation sites
+    if kind is None:
+        yield
+    elif kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+    elif kind == 'tracemalloc':
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            print(f"Traced memory: {current / 2**20:.1f} MB now, {peak / 2**20:.1f} MB peak.")
+            for statistic in snapshot.statistics('lineno')[:top]:
+                print(statistic)
+    else:
+        raise ValueError("Profiling must be None, 'cprofile' or 'tracemalloc'.")
@@ -0,0 +1,39 @@
+import numpy as np
+
+WGS84_A = 6378137.0  # semi-major axis in meters
+WGS84_E2 = 6.69437999014e-3  # first eccentricity squared
+# Absolute coordinates are always float64: float32 steps are ~1 m in longitude, too coarse for map matching
+COORDINATE_DTYPE = np.float64
+
+class LocalProjection:
+    def __init__(self, lat0, lon0):
+        # Local east/north plane in meters around (lat0, lon0), a flat ENU frame tangent to the WGS84 ellipsoid
+        # Scaled by the radii of curvature at the origin, so lateral offsets are true meters at any latitude, unlike
+        # distances in raw degrees; the east scale is only exact at lat0 and drifts by about tan(lat0) * (lat - lat0)
+        # (radians) away from it, ~0.1% 10 km north or south of the origin at 37 degrees, i.e. a few meters of offset
+        # across a large bounding box: fine for matching fixes to nearby edges, edge lengths come from the road graph
+        self.lat0 = float(lat0)
+        self.lon0 = float(lon0)
+        sin_lat = np.sin(np.radians(self.lat0))
+        w = np.sqrt(1 - WGS84_E2 * sin_lat**2)
+        self.meters_per_lat = np.radians(WGS84_A * (1 - WGS84_E2) / w**3)
+        self.meters_per_lon = np.radians(WGS84_A / w * np.cos(np.radians(self.lat0)))
+
+    @classmethod
+    def around(cls, lat, lon):
+        # Centered on the bounding box of the given coordinates
+        return cls((np.min(lat) + np.max(lat)) / 2, (np.min(lon) + np.max(lon)) / 2)
+
+    def forward(self, lat, lon):
+        # [lat, lon] degrees to [east, north] meters, one row per point
+        return np.column_stack(((np.asarray(lon, dtype=np.float64) - self.lon0) * self.meters_per_lon,
+                                (np.asarray(lat, dtype=np.float64) - self.lat0) * self.meters_per_lat))
+
+def project_onto_segments(A, B, P):
+    # Closest point on every segment AB to the matching point P, all as (n, 2) metric arrays
+    # Returns the fraction t along each segment, clamped to [0, 1], and the projected points
+    AB = B - A
+    AB_squared = np.einsum('ij,ij->i', AB, AB)
+    t = np.divide(np.einsum('ij,ij->i', P - A, AB), AB_squared, out=np.zeros(len(P)), where=AB_squared > 0)
+    t = np.clip(t, 0, 1)
+    return t, A + t[:, None] * AB
@@ -1,32 +1,72 @@
 import plotly.graph_objects as go
 import pandas as pd
-import osmnx as ox
 import numpy as np
-import networkx as nx
+import os
+import time
+from edge_index import EdgeIndex
+from graph_cache import GraphCache
+from map_source import OverpassSource
+from horizon import IncrementalHorizon
+from gnss_stream import FixBuffer, GNSS_COLUMNS, load_gnss_parquet
+from parallel import calculate_parallel
+from tile_loader import TileLoader
+from ego_frame import make_frame, empty_frame, frame_to_map, EgoFrameWriter
+from map_export import MapHtmlWriter
+from scheduler import UpdateScheduler, step_distance, track_distance
+from latency_stats import LatencyStats, REALTIME_BUDGET, profiling, ego_graph_nbytes
+from route_corridor import RouteCorridor
+
+ROUTE_TRACE_SPACING = 10  # meters between the points of the plotted route
 
 class MapEngine:
-    def __init__(self):
-        self.latlong_all = []
+    def __init__(self, cache_path="graph_cache", map_source=None, scheduler=None):
+        # map_source: where road graphs come from, OverpassSource() (default) or PbfSource(path) for offline use
+        # scheduler: decides which samples get a fresh horizon, UpdateScheduler() by default
         self.latlong = []
+        self.route_latlong = []  # the drive thinned out for the route trace of the map
         self.time = []
+        self.distance = None  # meters driven at every sample
         self.bounding_box = None
-        self.osm_graph = None
-        self.ego_map = None
+        self.road_graph = None
+        self.edge_index = None
+        self.ego_map = None  # one ego frame (see ego_frame.py) per sample, shared by the samples between updates
+        self.updates = []  # indices of the samples the horizon was recomputed at
+        self.stats = None  # LatencyStats of the last run
+        self.frame_origin = None
+        self.tile_loader = None
+        self.map_source = map_source if map_source is not None else OverpassSource()
+        self.graph_cache = GraphCache(cache_path) if cache_path else None
+        self.scheduler = scheduler if scheduler is not None else UpdateScheduler()
 
-    def set_gnss_data(self, path):
-        # Load the data
-        gnss_data_all = pd.read_csv(path)
+    def set_gnss_data(self, path, tiled=False, stride=1, row_groups=None):
+        # path: drive CSV, or Parquet file (.parquet, e.g. from GnssSimulator.save_virtual_drive)
+        # tiled: load fixed map tiles along the drive instead of one bounding box around all of it
+        # stride: keep every stride-th sample only, the others are never loaded
+        # row_groups: indices of the row groups of a Parquet drive to load (all by default), e.g. to process part of a long log
+        if stride < 1:
+            raise ValueError("Stride must be at least 1.")
 
-        # Subsample the dataframe
-        data_reduction_factor = 10
-        map_reduction_factor = 20
-        gnss_data_all = gnss_data_all.iloc[::data_reduction_factor].reset_index(drop=True)
-        gnss_data = gnss_data_all.iloc[::map_reduction_factor].reset_index(drop=True)
+        # Load the data, only the time and position columns are read
+        if path.endswith('.parquet'):
+            gnss_data = pd.DataFrame(load_gnss_parquet(path, stride, row_groups), copy=False)
+        elif row_groups is not None:
+            raise ValueError("Row groups can only be selected in Parquet drives.")
+        else:
+            skiprows = (lambda row: row > 0 and (row - 1) % stride != 0) if stride > 1 else None
+            gnss_data = pd.read_csv(path, usecols=GNSS_COLUMNS, skiprows=skiprows)
 
-        # Extract latitude, longitude, and time
-        self.latlong_all = gnss_data_all[['latitude_deg', 'longitude_deg']].values.tolist()
+        # Extract latitude, longitude, time and distance driven
+        # Every sample is kept, the scheduler decides which ones are worth a new horizon
         self.latlong = gnss_data[['latitude_deg', 'longitude_deg']].values.tolist()
         self.time = (gnss_data['timestamp_s'] - gnss_data['timestamp_s'].min()).round(1).values.tolist()
+        self.distance = track_distance(self.latlong)
+        self.frame_origin = self.latlong[0]
+
+        # The route trace only needs a point every ROUTE_TRACE_SPACING meters, so plots stay light on long drives
+        trace = np.flatnonzero(np.diff(np.floor(self.distance / ROUTE_TRACE_SPACING), prepend=-1) > 0).tolist()
+        if trace[-1] != len(self.latlong) - 1:
+            trace.append(len(self.latlong) - 1)
+        self.route_latlong = [self.latlong[i] for i in trace]
 
         # Calculate bounding box
         latitudes = [lat for lat, lon in self.latlong]
@@ -38,147 +78,304 @@ class MapEngine:
             'top': max(latitudes)+0.01
         }
 
-        # Fetch the OSM graph for the bounding box
+        # Fetch the road graph around the drive, or only the map tiles along it as the drive is processed
+        if self.tile_loader is not None:
+            self.tile_loader.close()
+        if tiled:
+            self.tile_loader = TileLoader(self.fetch_road_graph)
+        else:
+            self.tile_loader = None
+            self.load_road_graph(self.bounding_box)
+
+    def load_road_graph(self, bounding_box, use_cache=True):
+        # bounding_box: dict with 'left', 'bottom', 'right', 'top' in degrees
+        # use_cache: reuse a graph cached on disk by an earlier run over the same (or a larger) area
+        self.bounding_box = bounding_box
+        self.road_graph = self.fetch_road_graph(bounding_box, use_cache)
+        if self.road_graph.num_edges == 0:
+            raise ValueError("No motorway found in the bounding box.")
+
+        # Build the edge spatial index once for batch map matching
+        self.edge_index = EdgeIndex(self.road_graph)
+
+    def fetch_road_graph(self, bounding_box, use_cache=True):
+        # Return the motorway graph of the bounding box, from the cache or from the map source
+        use_cache = use_cache and self.graph_cache is not None
         highway_types = ['motorway', 'motorway_link']
-        self.osm_graph = ox.graph.graph_from_bbox(
-            bbox=(self.bounding_box['left'], self.bounding_box['bottom'], self.bounding_box['right'], self.bounding_box['top']),
-            network_type='drive',
-            simplify=False,
-            retain_all=True,
-            custom_filter=f'["highway"~"{ "|".join(highway_types) }"]'
-        )
-        self.osm_graph = ox.distance.add_edge_lengths(self.osm_graph)
-        print(f"OSM graph fetched with {len(self.osm_graph.nodes)} nodes and {len(self.osm_graph.edges)} edges.")
+        options = {'highway_types': highway_types, **self.map_source.options}
+
+        road_graph = self.graph_cache.lookup(bounding_box, **options) if use_cache else None
+        if road_graph is not None:
+            print(f"Road graph loaded from cache with {road_graph.num_nodes} nodes and {road_graph.num_edges} edges.")
+            return road_graph
+
+        road_graph = self.map_source.fetch(bounding_box, highway_types)
+        # An empty graph may come from a failed or truncated response, so it is fetched again next time
+        if use_cache and road_graph.num_edges > 0:
+            self.graph_cache.store(road_graph, bounding_box, **options)
+        return road_graph
 
-    def calculate_realtime_map(self):
+    def build_corridor(self, path=None):
+        # Match the whole drive once to the route it follows, for replays that slice every horizon out of it
+        # path: route corridor index file, reused when it was built for this drive and road graph, (re)written otherwise
+        if self.tile_loader is not None:
+            raise ValueError("Tiled maps are calculated in this process, workers and corridors are not supported.")
+        if path is not None and os.path.exists(path):
+            try:
+                corridor = RouteCorridor.load(path, self.road_graph, self.latlong)
+                print(f"Route corridor loaded from {path} with {len(corridor.edges)} edges.")
+                return corridor
+            except ValueError as e:
+                print(f"Rebuilding the route corridor: {e}")
+        corridor = RouteCorridor.build(self.road_graph, self.edge_index, self.latlong)
+        if path is not None:
+            corridor.save(path)
+        return corridor
+
+    def calculate_realtime_map(self, incremental=False, workers=None, callback=None, profile=None, corridor=None):
+        # incremental: advance the previous horizon instead of rebuilding it on every update
+        # workers: number of processes to shard the drive across (0 or None computes it in this process)
+        # corridor: RouteCorridor of this drive (see build_corridor), every horizon is then a slice of it instead of a search
+        # callback: called with the timing record of every computed tick, all of them end up in self.stats
+        # profile: None, 'cprofile' or 'tracemalloc' to profile the whole run
+        # Only the samples picked by the scheduler get a new horizon, the others reuse the last ego map
         print("Calculating real-time map...")
         self.ego_map = []
-        for latlong in self.latlong:
-            print(f"Progress: {round((self.latlong.index(latlong) + 1) / len(self.latlong) * 100, 2)}%")
-            ego_graph = self.get_map_at_latlong(latlong)
-            map = self.ego_graph_to_map(ego_graph)
-            self.ego_map.append(map)
-
-    def get_map_at_latlong(self, latlong):
-        FORWARD_DISTANCE_THRESHOLD = 1000  # meters
-        BACKWARD_DISTANCE_THRESHOLD = 250
-        # print("latlong:", latlong)
+        self.updates = []
+        self.stats = LatencyStats(callback=callback)
+        if self.distance is None or len(self.distance) != len(self.latlong):
+            self.distance = track_distance(self.latlong)
+        with profiling(profile):
+            if self.tile_loader is not None:
+                if workers or corridor is not None:
+                    raise ValueError("Tiled maps are calculated in this process, workers and corridors are not supported.")
+                self.calculate_tiled_realtime_map(incremental)
+            elif corridor is not None:
+                if len(corridor.sample_position) != len(self.latlong):
+                    raise ValueError("The route corridor was built for another drive.")
+                due = self.scheduler.schedule(self.distance, corridor.sample_edge)
+                self.add_frames(self.calculate_corridor_frames(corridor, np.flatnonzero(due)), due, 0)
+            else:
+                # Match the whole drive in one vectorized call, its time is shared out evenly over the samples
+                start_time = time.perf_counter()
+                matches = self.edge_index.match(self.latlong)
+                match_time = (time.perf_counter() - start_time) / len(self.latlong)
+                due = self.scheduler.schedule(self.distance, matches['edge'])
+                indices = np.flatnonzero(due)
+                if workers:
+                    frames, stats = calculate_parallel(self.road_graph, {name: value[due] for name, value in matches.items()},
+                                                       self.frame_origin, indices, match_time, workers)
+                    self.stats.merge(stats)
+                else:
+                    horizon = IncrementalHorizon(self.road_graph) if incremental else None
+                    frames = self.calculate_frames(indices, {name: value[due] for name, value in matches.items()}, horizon, match_time)
+                self.add_frames(frames, due, 0)
+        print(f"Updated the horizon at {len(self.updates)} of {len(self.latlong)} samples ({self.distance[-1] / 1000:.1f} km).")
+        self.stats.report()
 
-        # Map matching
-            # Find ego_edge: the edge closest to the current position
-            # Find ego_pose: nearest point on the edge to GNSS position
-            # Find distance to next node
-            # Find distance to previous node
-        ego_edge, dist = ox.distance.nearest_edges(
-            self.osm_graph,
-            X=latlong[1],  # longitude
-            Y=latlong[0],  # latitude
-            return_dist=True
-        )
-        # print(f"Ego edge found: {ego_edge}, Distance to edge: {dist} meters")
-        forward_node_id = ego_edge[1]  # The node at the end of the edge
-        forward_node_data = self.osm_graph.nodes[forward_node_id]  # The node at the end of the edge
-        forward_latlon = forward_node_data['y'], forward_node_data['x']
-        backward_node_id = ego_edge[0]  # The node at the start of the edge
-        backward_node_data = self.osm_graph.nodes[backward_node_id]  # The node at the start of the edge
-        backward_latlon = backward_node_data['y'], backward_node_data['x']
+    def calculate_tiled_realtime_map(self, incremental=False, prefetch=3):
+        # Walk the drive one tile window at a time, the road graph only ever holds the tiles around the vehicle
+        # prefetch: number of upcoming windows fetched in the background while the current one is processed
+        loader = self.tile_loader
+        windows = [loader.window(lat, lon) for lat, lon in self.latlong]
+        starts = [i for i in range(len(windows)) if i == 0 or windows[i] != windows[i - 1]]
+        ends = starts[1:] + [len(windows)]
+        try:
+            self.calculate_tile_windows(windows, starts, ends, incremental, prefetch)
+        finally:
+            # No background fetch outlives the run
+            loader.close()
+        print(f"Used {len(starts)} tile windows, fetched {loader.fetch_count} tiles, evicted {loader.evict_count}, "
+              f"{loader.nbytes / 2**20:.1f} MB of tiles loaded.")
 
-        ego_pose = self.closest_point_on_line(forward_latlon, backward_latlon, latlong)
-        # print(f"Ego pose: {ego_pose}")
+    def calculate_tile_windows(self, windows, starts, ends, incremental, prefetch):
+        loader = self.tile_loader
+        for run, (start, end) in enumerate(zip(starts, ends)):
+            for next_start in starts[run + 1:run + 1 + prefetch]:
+                loader.prefetch(windows[next_start])
 
-        forward_node_dist = ox.distance.great_circle(forward_latlon[0], forward_latlon[1], ego_pose[0], ego_pose[1])
-        backward_node_dist = ox.distance.great_circle(backward_latlon[0], backward_latlon[1], ego_pose[0], ego_pose[1])
-        # print(f"Forward node distance: {forward_node_dist}, Backward node distance: {backward_node_dist}")
+            # Samples sharing a window are matched in one call, the horizon starts over in every window
+            self.road_graph = loader.load(windows[start])
+            if self.road_graph.num_edges == 0:
+                due = np.zeros(end - start, dtype=bool)
+                due[0] = True
+                self.add_frames([empty_frame(self.frame_origin)], due, start)
+                continue
+            self.edge_index = EdgeIndex(self.road_graph)
+            start_time = time.perf_counter()
+            matches = self.edge_index.match(self.latlong[start:end])
+            match_time = (time.perf_counter() - start_time) / (end - start)
+            due = self.scheduler.schedule(self.distance[start:end], matches['edge'])
+            frames = self.calculate_frames(start + np.flatnonzero(due), {name: value[due] for name, value in matches.items()},
+                                           IncrementalHorizon(self.road_graph) if incremental else None, match_time)
+            self.add_frames(frames, due, start)
 
-        edge_length = self.osm_graph.edges[ego_edge]['length']
-        # print(f"Edge length: {edge_length} meters")
+    def calculate_frames(self, indices, matches, horizon=None, match_time=0.0):
+        # Ego frames at the given sample indices and their map matches, timing every stage into self.stats
+        # horizon: advance this incremental horizon, or build a fresh one for every sample when None
+        frames = []
+        ego_edges = matches['edge'].tolist()
+        for i, index in enumerate(np.asarray(indices).tolist()):
+            print(f"Progress: {round((i + 1) / len(indices) * 100, 2)}%")
+            match = (ego_edges[i], matches['forward_dist'][i], matches['backward_dist'][i])
+            start_time = time.perf_counter()
+            if horizon is not None:
+                ego_graph = horizon.update(*match)
+            else:
+                ego_graph = self.get_map_at_latlong(self.latlong[index], match)
+            horizon_time = time.perf_counter()
+            frame = self.ego_graph_to_frame(ego_graph)
+            end_time = time.perf_counter()
+            frames.append(frame)
+            self.stats.add_tick(index, match_time, horizon_time - start_time, end_time - horizon_time,
+                                len(ego_graph['edge']), ego_graph_nbytes(ego_graph, frame))
+        return frames
 
+    def calculate_corridor_frames(self, corridor, indices):
+        # Ego frames at the given sample indices, sliced out of the route corridor without any map matching or search
+        frames = []
+        for i, index in enumerate(np.asarray(indices).tolist()):
+            print(f"Progress: {round((i + 1) / len(indices) * 100, 2)}%")
+            start_time = time.perf_counter()
+            ego_graph = corridor.horizon(index, self.road_graph)
+            horizon_time = time.perf_counter()
+            frame = self.ego_graph_to_frame(ego_graph)
+            end_time = time.perf_counter()
+            frames.append(frame)
+            self.stats.add_tick(index, 0.0, horizon_time - start_time, end_time - horizon_time,
+                                len(ego_graph['edge']), ego_graph_nbytes(ego_graph, frame))
+        return frames
 
-        # Calculate horizon
-            # Create empty ego_graph
-            # Add ego_edge
-            # Add forward edges upto 500m
-            # Add backward edges upto 100m
-        ego_graph = nx.MultiDiGraph()
-        nodes = [{'id': forward_node_id, 'dist': forward_node_dist, 'direction': 'forward'},
-                 {'id': backward_node_id, 'dist': backward_node_dist, 'direction': 'backward'}]
-        ego_graph.add_node(ego_edge[0], **backward_node_data)
-        ego_graph.add_node(ego_edge[1], **forward_node_data)
-        default_color = 0
-        ego_graph.add_edge(ego_edge[0], ego_edge[1], default_color, **self.osm_graph.edges[ego_edge])
-
-        while nodes:
-            current_node = nodes.pop(0)
-            current_id = current_node['id']
-            current_dist = current_node['dist']
-            current_direction = current_node['direction']
-
-            if current_direction == 'forward' and current_dist < FORWARD_DISTANCE_THRESHOLD:
-                # Forward direction: add neighbors
-                for neighbor in self.osm_graph.neighbors(current_id):
-                    # Check if the neighbor is already in the ego_graph
-                    if neighbor in ego_graph.nodes:
-                        continue
-                    neighbor_data = self.osm_graph.nodes[neighbor]
-                    edge_id = (current_id, neighbor, default_color)
-                    edge_data = self.osm_graph.edges[edge_id]
-                    ego_graph.add_node(neighbor, **neighbor_data)
-                    ego_graph.add_edge(current_id, neighbor, default_color, **edge_data)
-                    nodes.append({'id': neighbor, 'dist': current_dist + edge_data['length'], 'direction': 'forward'})
-            elif current_direction == 'backward' and current_dist < BACKWARD_DISTANCE_THRESHOLD:
-                # Backward direction: add neighbors
-                for neighbor in self.osm_graph.predecessors(current_id):
-                    # Check if the neighbor is already in the ego_graph
-                    if neighbor in ego_graph.nodes:
+    def add_frames(self, frames, due, start):
+        # Extend the ego map with one frame per sample, samples between updates share the last frame
+        self.updates.extend((start + np.flatnonzero(due)).tolist())
+        self.ego_map.extend(frames[i] for i in (np.cumsum(due) - 1).tolist())
+
+    def stream_realtime_map(self, fixes, latency_budget=REALTIME_BUDGET, policy='coalesce', max_backlog=100, callback=None):
+        # Yield one ego map per GNSS fix from a live feed, without keeping the drive in memory
+        # fixes: any iterable of (timestamp_s, latitude_deg, longitude_deg), e.g. read_gnss_socket() or pace(read_gnss_csv())
+        # latency_budget: seconds allowed from the arrival of a fix to its ego map
+        # policy: when falling behind, 'coalesce' jumps straight to the newest fix,
+        #         'drop' skips only the fixes already older than the latency budget
+        # callback: called with the timing record of every processed fix, all of them end up in self.stats
+        if self.road_graph is None:
+            raise ValueError("No road graph loaded. Please call load_road_graph() before streaming.")
+        if policy not in ('coalesce', 'drop'):
+            raise ValueError("Policy must be 'coalesce' or 'drop'.")
+
+        horizon = IncrementalHorizon(self.road_graph)
+        buffer = FixBuffer(fixes, max_backlog)
+        self.stats = LatencyStats(latency_budget, callback)
+        origin = self.frame_origin
+        self.scheduler.reset()
+        distance, previous_latlong, frame, ego_graph = 0.0, None, None, None
+        processed, skipped, over_budget = 0, 0, 0
+        try:
+            while True:
+                pending = buffer.take()
+                if not pending:
+                    break
+                if policy == 'coalesce':
+                    skipped += len(pending) - 1
+                    pending = pending[-1:]
+
+                for i, (arrival, fix) in enumerate(pending):
+                    # The newest fix is always processed, so the map never starves under load
+                    if policy == 'drop' and i < len(pending) - 1 and time.perf_counter() - arrival > latency_budget:
+                        skipped += 1
                         continue
+                    timestamp, lat, lon = fix[:3]
+                    if origin is None:
+                        origin = [lat, lon]
+                    if previous_latlong is not None:
+                        distance += float(step_distance(previous_latlong[0], previous_latlong[1], lat, lon))
+                    previous_latlong = (lat, lon)
 
-                    neighbor_data = self.osm_graph.nodes[neighbor]
-                    edge_id = (neighbor, current_id, default_color)
-                    edge_data = self.osm_graph.edges[edge_id]
-                    ego_graph.add_node(neighbor, **neighbor_data)
-                    ego_graph.add_edge(neighbor, current_id, default_color, **edge_data)
-                    nodes.append({'id': neighbor, 'dist': current_dist + edge_data['length'], 'direction': 'backward'})
-
-        # print(f"Ego graph created with {len(ego_graph.nodes)} nodes and {len(ego_graph.edges)} edges.")
-        # Copy the CRS from the original graph to the ego_graph
-        # ego_graph.graph['crs'] = local_map_graph.graph.get('crs', 'epsg:4326')
-        # ox.plot_graph(ego_graph)
-        return ego_graph
+                    # Between scheduled updates the last ego map is handed out again
+                    start_time = time.perf_counter()
+                    match = self.edge_index.match([(lat, lon)])
+                    match_time = time.perf_counter()
+                    if self.scheduler.due(distance, int(match['edge'][0])):
+                        ego_graph = horizon.update(match['edge'][0], match['forward_dist'][0], match['backward_dist'][0])
+                        horizon_time = time.perf_counter()
+                        frame = self.ego_graph_to_frame(ego_graph, origin)
+                    else:
+                        horizon_time = match_time
+                    end_time = time.perf_counter()
+                    latency = end_time - arrival
+                    self.stats.add_tick(processed, match_time - start_time, horizon_time - match_time, end_time - horizon_time,
+                                        len(ego_graph['edge']), ego_graph_nbytes(ego_graph, frame), latency)
+                    processed += 1
+                    if latency > latency_budget:
+                        over_budget += 1
+                    yield {'timestamp_s': timestamp, 'latlong': [lat, lon], 'ego_graph': ego_graph, 'ego_map': frame,
+                           'latency_s': latency, 'skipped': skipped + buffer.overflow}
+        finally:
+            # Runs too when the consumer stops early or the loop raises, so the reader thread stops with it
+            buffer.close()
 
-    def closest_point_on_line(self, A, B, P):
-        # A and B are the endpoints of the line segment
-        # P is the point for which we want to find the closest point on the line segment AB
-        # Convert points to numpy arrays
-        A = np.array(A)
-        B = np.array(B)
-        P = np.array(P)
+        print(f"Streamed {processed} ego maps with {self.scheduler.update_count} horizon updates, skipped {skipped + buffer.overflow} fixes, {over_budget} over the {latency_budget * 1000:.0f} ms budget.")
 
-        # Vector AB and AP
-        AB = B - A
-        AP = P - A
+    def get_map_at_latlong(self, latlong, match=None):
+        # print("latlong:", latlong)
 
-        # Projection of AP onto AB
-        t = np.dot(AP, AB) / np.dot(AB, AB)
+        # Map matching
+            # Find ego_edge: the edge closest to the current position
+            # Find ego_pose: nearest point on the edge to GNSS position
+            # Find distance to next node
+            # Find distance to previous node
+        if match is None:
+            matches = self.edge_index.match([latlong])
+            match = (int(matches['edge'][0]), matches['forward_dist'][0], matches['backward_dist'][0])
+        ego_edge, forward_node_dist, backward_node_dist = match
+        # print(f"Ego edge found: {ego_edge}, Forward node distance: {forward_node_dist}, Backward node distance: {backward_node_dist}")
+
+        # Calculate horizon
+            # Start from ego_edge
+            # Add forward edges upto 1000m
+            # Add backward edges upto 250m
+            # A fresh horizon is a full bounded Dijkstra search around the ego pose
+            # The result holds edge indices into the road graph, with the part of each edge inside the horizon
+        ego_graph = IncrementalHorizon(self.road_graph).update(ego_edge, forward_node_dist, backward_node_dist)
+        # print(f"Ego graph created with {len(ego_graph['edge'])} edges.")
+        # ox.plot_graph(self.road_graph.to_networkx(ego_graph['edge']))
+        return ego_graph
 
-        # Clamp t to the range [0, 1] if you want the closest point on the segment
-        t = max(0, min(1, t))
+    def ego_graph_to_frame(self, ego_graph, origin=None):
+        # Line segments clipped to the part of each edge inside the horizon, as a compact ego frame
+        u = self.road_graph.edge_source[ego_graph['edge']]
+        v = self.road_graph.edge_target[ego_graph['edge']]
+        u_latlon = np.column_stack((self.road_graph.node_lat[u], self.road_graph.node_lon[u]))
+        v_latlon = np.column_stack((self.road_graph.node_lat[v], self.road_graph.node_lon[v]))
+        start, end = ego_graph['start'][:, None], ego_graph['end'][:, None]
+        origin = origin if origin is not None else self.frame_origin
+        return make_frame(u_latlon + start * (v_latlon - u_latlon), u_latlon + end * (v_latlon - u_latlon),
+                          origin if origin is not None else u_latlon[0])
+
+    def save_ego_map(self, path, delta=True):
+        # Write the ego frames of the drive to a binary stream file, read it back with ego_frame.EgoFrameReader
+        with EgoFrameWriter(path, delta) as writer:
+            for frame in self.ego_map:
+                writer.write(frame)
+        print(f"Saved {len(self.ego_map)} ego frames to {path}.")
 
-        # Closest point on the line
-        closest_point = A + t * AB
-        return closest_point
-    
     def ego_graph_to_map(self, ego_graph):
-        map = {'lat':[] , 'lon': []}
-        # Collect line segments
-        for u, v, key, data in ego_graph.edges(keys=True, data=True):
-            u_data = ego_graph.nodes[u]
-            v_data = ego_graph.nodes[v]
-            map['lat'].extend((u_data['y'], v_data['y'], None))
-            map['lon'].extend((u_data['x'], v_data['x'], None))
-        return map
+        # The horizon as {'lat': [...], 'lon': [...]} lists with None between segments
+        return frame_to_map(self.ego_graph_to_frame(ego_graph))
 
+    def export_map(self, path, every=1, frame_duration=1000, include_plotlyjs=True):
+        # Stream the drive animation to a standalone HTML file instead of building one plotly frame per tick
+        # One tick per horizon update, every: keep every n-th tick, frame_duration: milliseconds per tick when playing
+        data, layout = self.create_map_figure()
+        layout.updatemenus = layout.updatemenus[:1]  # the page has its own play button and slider
+        layout.sliders = []
+        with MapHtmlWriter(path, go.Figure(data=data, layout=layout), frame_duration, include_plotlyjs) as writer:
+            for i in self.updates[::every]:
+                writer.add_tick(self.ego_map[i], self.latlong[i], self.time[i])
+        print(f"Exported {writer.tick_count} ticks with {len(writer.ego_maps)} distinct ego maps and {len(writer.segments)} segments to {path}.")
 
-    def plot_map(self):
+    def create_map_figure(self):
+        # Route, ego map and current position traces with the map layout, shared by plot_map and export_map
         # Set Zoom level and center
         zoom = 10
         center_lat = sum([lat for lat, lon in self.latlong]) / len(self.latlong)
@@ -186,16 +383,17 @@ class MapEngine:
 
         # Initialize "data" attribute for plotly figure
         data1 = go.Scattermap(
-            lat=[lat for lat, lon in self.latlong_all],
-            lon=[lon for lat, lon in self.latlong_all],
+            lat=[lat for lat, lon in self.route_latlong],
+            lon=[lon for lat, lon in self.route_latlong],
             mode='lines',
             line=dict(width=10, color='blue'),
             opacity=0.2,
             name='Route',
         )
+        first_map = frame_to_map(self.ego_map[0])
         data2 = go.Scattermap(
-            lat=[lat for lat in self.ego_map[0]['lat']],
-            lon=[lon for lon in self.ego_map[0]['lon']],
+            lat=first_map['lat'],
+            lon=first_map['lon'],
             mode='lines+markers',
             marker=dict(size=5, color='green'),
             line=dict(width=5, color='green'),
@@ -249,16 +447,22 @@ class MapEngine:
                 )
             ]
         )
+        return [data1, data2, data3], layout
+
+    def plot_map(self):
+        data, layout = self.create_map_figure()
 
         # Initialize animation frames
+        # One animation frame per horizon update, the samples in between share its ego map
         frames = []
-        for i in range(len(self.latlong)):
+        for i in self.updates:
+            ego_map = frame_to_map(self.ego_map[i])
             frame = go.Frame(
                 name=str(i),
                 data=[
                     go.Scattermap(
-                        lat=self.ego_map[i]['lat'],
-                        lon=self.ego_map[i]['lon'],
+                        lat=ego_map['lat'],
+                        lon=ego_map['lon'],
                     ),
                     go.Scattermap(
                         lat=[self.latlong[i][0]],
@@ -277,7 +481,7 @@ class MapEngine:
         
         # Initialize slider steps
         steps = []
-        for i in range(len(self.latlong)):
+        for i in self.updates:
             step = go.layout.slider.Step(
                 method='animate',
                 args=[[str(i)], {"frame": {"duration": 1000, "redraw": True}, "mode": "immediate", "transition": {"duration": 0}}],
@@ -287,7 +491,7 @@ class MapEngine:
         layout['sliders'][0]['steps'] = steps
 
         # Create the map figure
-        fig = go.Figure(data=[data1, data2, data3], layout=layout, frames=frames)
+        fig = go.Figure(data=data, layout=layout, frames=frames)
         fig.show(renderer="browser")
 
         # print("Dictionary Representation of A Graph Object:\n\n" + str(fig.to_dict()))
\ No newline at end of file
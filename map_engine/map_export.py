@@ -0,0 +1,145 @@
+import hashlib
+import json
+import plotly.offline
+from ego_frame import frame_latlon
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+{plotlyjs}
+</head>
+<body style="margin:0;font-family:sans-serif">
+<div id="map" style="width:100%;height:92vh"></div>
+<div style="display:flex;align-items:center;gap:1em;padding:0 1em">
+<button id="play">Play</button>
+<input id="slider" type="range" min="0" value="0" style="flex:1">
+<span id="time"></span>
+</div>
+<script>
+// S: unique segments as flat [lat, lon, lat, lon, ...], G: unique ego maps as lists of segment indices,
+// T: ticks as [ego map index, lat, lon, time]
+const S = [], G = [], T = [];
+"""
+
+PAGE_TAIL = """const figure = {figure};
+const frameDuration = {frame_duration};
+const slider = document.getElementById('slider');
+const label = document.getElementById('time');
+const play = document.getElementById('play');
+slider.max = Math.max(T.length - 1, 0);
+play.disabled = slider.disabled = T.length === 0;
+
+function egoMap(index) {{
+    const lat = [], lon = [];
+    for (const segment of G[index]) {{
+        const coords = S[segment];
+        for (let k = 0; k < coords.length; k += 2) {{
+            lat.push(coords[k]);
+            lon.push(coords[k + 1]);
+        }}
+        lat.push(null);
+        lon.push(null);
+    }}
+    return [lat, lon];
+}}
+
+let shown = -1;
+function show(i) {{
+    const [g, lat, lon, time] = T[i];
+    const update = {{}};
+    if (g !== shown) {{
+        [update.lat, update.lon] = egoMap(g);
+        Plotly.restyle('map', update, [1]);
+        shown = g;
+    }}
+    Plotly.update('map', {{lat: [[lat]], lon: [[lon]]}}, {{'map.center': {{lat: lat, lon: lon}}, 'map.zoom': 14}}, [2]);
+    slider.value = i;
+    label.textContent = 'Time: ' + time;
+}}
+
+let timer = null;
+play.onclick = () => {{
+    if (timer !== null) {{
+        clearInterval(timer);
+        timer = null;
+        play.textContent = 'Play';
+        return;
+    }}
+    play.textContent = 'Pause';
+    timer = setInterval(() => {{
+        const next = Number(slider.value) + 1;
+        if (next >= T.length) {{
+            play.onclick();
+        }} else {{
+            show(next);
+        }}
+    }}, frameDuration);
+}};
+slider.oninput = () => show(Number(slider.value));
+// A drive without ticks still shows its route
+Plotly.newPlot('map', figure.data, figure.layout).then(() => {{ if (T.length > 0) show(0); }});
+</script>
+</body>
+</html>
+"""
+
+class MapHtmlWriter:
+    def __init__(self, path, figure, frame_duration=1000, include_plotlyjs=True):
+        # Streams an animated map to a standalone HTML page, one tick at a time
+        # Every segment and every distinct ego map is written once, ticks only reference them by index,
+        # so neither the page nor this writer ever holds one copy of the map per tick
+        # figure: plotly figure with the route, ego map and position traces (in that order), without frames
+        # include_plotlyjs: True embeds plotly.js so the page works offline, False loads it from the CDN
+        self.path = path
+        self.figure = figure
+        self.frame_duration = frame_duration
+        self.segments = {}  # segment digest -> index
+        self.ego_maps = {}  # ego map digest -> index
+        self.previous = None  # (frame, ego map index) of the last tick, consecutive ticks often repeat it
+        self.tick_count = 0
+        if include_plotlyjs:
+            plotlyjs = f'<script type="text/javascript">{plotly.offline.get_plotlyjs()}</script>'
+        else:
+            plotlyjs = f'<script src="https://cdn.plot.ly/plotly-{plotly.offline.get_plotlyjs_version()}.min.js" charset="utf-8"></script>'
+        self.file = open(path, 'w')
+        self.file.write(PAGE_HEAD.format(title=figure.layout.title.text or 'Map', plotlyjs=plotlyjs))
+
+    def add_tick(self, frame, latlong, time):
+        # frame: ego frame of the tick, latlong: vehicle position, time: slider label
+        if self.previous is not None and self.previous[0] is frame:
+            ego_map = self.previous[1]
+        else:
+            ego_map = self.add_ego_map(frame)
+        self.previous = (frame, ego_map)
+        self.file.write(f"T.push([{ego_map},{latlong[0]:.7f},{latlong[1]:.7f},{json.dumps(time)}]);\n")
+        self.tick_count += 1
+
+    def add_ego_map(self, frame):
+        latlon = frame_latlon(frame).round(7)
+        offsets = frame['offsets'].tolist()
+        segment_ids = []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            coords = latlon[start:end]
+            digest = hashlib.sha1(coords.tobytes()).digest()
+            if digest not in self.segments:
+                self.segments[digest] = len(self.segments)
+                self.file.write(f"S.push({json.dumps(coords.ravel().tolist())});\n")
+            segment_ids.append(self.segments[digest])
+
+        digest = hashlib.sha1(bytes(str(segment_ids), 'ascii')).digest()
+        if digest not in self.ego_maps:
+            self.ego_maps[digest] = len(self.ego_maps)
+            self.file.write(f"G.push({json.dumps(segment_ids)});\n")
+        return self.ego_maps[digest]
+
+    def close(self):
+        self.file.write(PAGE_TAIL.format(figure=self.figure.to_json(), frame_duration=self.frame_duration))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,107 @@
+import os
+import re
+import threading
+import numpy as np
+import networkx as nx
+import osmnx as ox
+import osmium
+from osmnx._errors import InsufficientResponseError
+from road_graph import RoadGraph
+
+# The values OSM uses in its "oneway" tag for one-way roads, and for roads drawn against the direction of travel
+# Same as OSMnx, so both sources build the same graph
+ONEWAY_VALUES = {"yes", "true", "1", "-1", "reverse", "T", "F"}
+REVERSED_VALUES = {"-1", "reverse", "T"}
+
+class OverpassSource:
+    def __init__(self, network_type='drive'):
+        # Fetch the road graph live from the Overpass API through OSMnx
+        self.network_type = network_type
+        self.options = {'network_type': network_type, 'simplify': False, 'retain_all': True}
+
+    def fetch(self, bounding_box, highway_types):
+        try:
+            osm_graph = ox.graph.graph_from_bbox(
+                bbox=(bounding_box['left'], bounding_box['bottom'], bounding_box['right'], bounding_box['top']),
+                network_type=self.network_type,
+                simplify=False,
+                retain_all=True,
+                custom_filter=f'["highway"~"{ "|".join(highway_types) }"]'
+            )
+            osm_graph = ox.distance.add_edge_lengths(osm_graph)
+        except InsufficientResponseError:
+            # OSMnx raises when the area has no matching roads, which is normal for a map tile
+            osm_graph = nx.MultiDiGraph()
+        except ValueError as e:
+            # Also when the roads found have no nodes inside the bounding box, any other error is a real one
+            if "no graph nodes" not in str(e):
+                raise
+            osm_graph = nx.MultiDiGraph()
+        print(f"OSM graph fetched with {len(osm_graph.nodes)} nodes and {len(osm_graph.edges)} edges.")
+        return RoadGraph.from_osm_graph(osm_graph)
+
+class PbfSource:
+    def __init__(self, path):
+        # Build the road graph offline from a local .osm.pbf (or .osm) extract with pyosmium
+        # The file's modification time is part of the cache key, so a refreshed extract is read again
+        if not os.path.exists(path):
+            raise ValueError(f"Map file {path} not found.")
+        self.path = os.path.abspath(path)
+        self.options = {'pbf': self.path, 'modified': os.path.getmtime(self.path)}
+        self.graphs = {}  # highway types -> road graph of the whole extract
+        self.lock = threading.Lock()  # map tiles are fetched from background threads
+
+    def fetch(self, bounding_box, highway_types):
+        # The extract is read once per set of highway types, every request (e.g. each map tile) clips that graph
+        key = tuple(highway_types)
+        with self.lock:
+            if key not in self.graphs:
+                self.graphs[key] = self.parse(highway_types)
+        road_graph = self.graphs[key].clip(bounding_box)
+        print(f"PBF graph clipped to {road_graph.num_nodes} nodes and {road_graph.num_edges} edges.")
+        return road_graph
+
+    def parse(self, highway_types):
+        # Road graph of the whole extract
+        # First pass: the matching ways, with the same regex match as the Overpass filter
+        pattern = re.compile("|".join(highway_types))
+        paths = []
+        for way in osmium.FileProcessor(self.path, osmium.osm.WAY).with_filter(osmium.filter.KeyFilter('highway')):
+            if not pattern.search(way.tags['highway']):
+                continue
+            nodes = [node.ref for node in way.nodes]
+            oneway = way.tags.get('oneway') in ONEWAY_VALUES or way.tags.get('junction') == 'roundabout'
+            if oneway and way.tags.get('oneway') in REVERSED_VALUES:
+                nodes.reverse()
+            paths.append((nodes, oneway))
+
+        # Second pass: locations of only the nodes those ways use
+        node_ids = np.unique(np.array([node for nodes, oneway in paths for node in nodes], dtype=np.int64))
+        node_lat = np.full(len(node_ids), np.nan)
+        node_lon = np.full(len(node_ids), np.nan)
+        if len(node_ids):
+            for node in osmium.FileProcessor(self.path, osmium.osm.NODE).with_filter(osmium.filter.IdFilter(node_ids.tolist())):
+                i = np.searchsorted(node_ids, node.id)
+                node_lat[i], node_lon[i] = node.location.lat, node.location.lon
+
+        # Every pair of consecutive nodes is an edge, two-way roads get one in each direction
+        edge_u, edge_v = [], []
+        for nodes, oneway in paths:
+            edge_u.extend(nodes[:-1])
+            edge_v.extend(nodes[1:])
+            if not oneway:
+                edge_u.extend(nodes[1:])
+                edge_v.extend(nodes[:-1])
+        edge_u = np.searchsorted(node_ids, np.array(edge_u, dtype=np.int64))
+        edge_v = np.searchsorted(node_ids, np.array(edge_v, dtype=np.int64))
+
+        # Parallel edges between the same two nodes are numbered in the order they were added, as in a MultiDiGraph
+        order = np.lexsort((edge_v, edge_u))
+        pairs = edge_u[order] * len(node_ids) + edge_v[order]
+        group_start = np.r_[0, np.flatnonzero(np.diff(pairs)) + 1] if len(pairs) else np.zeros(0, dtype=np.int64)
+        edge_key = np.empty(len(order), dtype=np.int64)
+        edge_key[order] = np.arange(len(order)) - np.repeat(group_start, np.diff(np.r_[group_start, len(order)]))
+
+        edge_length = ox.distance.great_circle(node_lat[edge_u], node_lon[edge_u], node_lat[edge_v], node_lon[edge_v])
+        print(f"PBF extract read with {len(node_ids)} nodes and {len(edge_u)} edges.")
+        return RoadGraph(node_ids, node_lat, node_lon, edge_u, edge_v, edge_key, edge_length)
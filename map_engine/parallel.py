@@ -0,0 +1,58 @@
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from horizon import IncrementalHorizon
+from road_graph import RoadGraph
+from latency_stats import LatencyStats, ego_graph_nbytes
+
+worker_engine = None
+
+def init_worker(graph_directory):
+    # Each worker memory-maps the shared road graph read-only instead of receiving a pickled copy
+    global worker_engine
+    from map_engine import MapEngine
+    worker_engine = MapEngine(cache_path=None)
+    worker_engine.road_graph = RoadGraph.load(graph_directory)
+
+def calculate_shard(origin, match_time, indices, ego_edges, forward_dists, backward_dists):
+    # Consecutive samples advance one incremental horizon, which gives the same maps as rebuilding it every time
+    horizon = IncrementalHorizon(worker_engine.road_graph)
+    stats = LatencyStats()
+    frames = []
+    for index, ego_edge, forward_dist, backward_dist in zip(indices, ego_edges, forward_dists, backward_dists):
+        start_time = time.perf_counter()
+        ego_graph = horizon.update(ego_edge, forward_dist, backward_dist)
+        horizon_time = time.perf_counter()
+        frame = worker_engine.ego_graph_to_frame(ego_graph, origin)
+        end_time = time.perf_counter()
+        frames.append(frame)
+        stats.add_tick(index, match_time, horizon_time - start_time, end_time - horizon_time,
+                       len(ego_graph['edge']), ego_graph_nbytes(ego_graph, frame))
+    return frames, stats
+
+def calculate_parallel(road_graph, matches, origin, indices, match_time=0.0, workers=None, shard_size=None):
+    # Split the matched drive into contiguous shards, compute them on a process pool
+    # Returns the ego frames in order, with the timing stats of every tick
+    workers = workers or os.cpu_count()
+    num_samples = len(matches['edge'])
+    if shard_size is None:
+        shard_size = max(1, -(-num_samples // (workers * 4)))  # a few shards per worker to balance the load
+    starts = range(0, num_samples, shard_size)
+    columns = [np.asarray(indices)] + [matches[name] for name in ('edge', 'forward_dist', 'backward_dist')]
+    shards = [[column[start:start + shard_size].tolist() for start in starts] for column in columns]
+
+    # /dev/shm keeps the mapped graph in shared memory where available
+    graph_directory = tempfile.mkdtemp(prefix='road_graph_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        road_graph.save(graph_directory)
+        frames, stats = [], LatencyStats()
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(graph_directory,)) as pool:
+            for shard_frames, shard_stats in pool.map(calculate_shard, [origin] * len(starts), [match_time] * len(starts), *shards):
+                frames.extend(shard_frames)
+                stats.merge(shard_stats)
+        return frames, stats
+    finally:
+        shutil.rmtree(graph_directory, ignore_errors=True)
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import numpy as np
+import networkx as nx
+from local_projection import COORDINATE_DTYPE
+
+class RoadGraph:
+    # Every array that makes up the graph, in the order they are stored on disk
+    ARRAYS = ('node_ids', 'node_lat', 'node_lon', 'edge_source', 'edge_target', 'edge_key', 'edge_length',
+              'out_offsets', 'in_edges', 'in_offsets')
+
+    def __init__(self, node_ids, node_lat, node_lon, edge_source, edge_target, edge_key, edge_length):
+        # Nodes are sorted by OSM id, so an id is looked up with a binary search instead of a dict
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.node_lat = np.asarray(node_lat, dtype=COORDINATE_DTYPE)
+        self.node_lon = np.asarray(node_lon, dtype=COORDINATE_DTYPE)
+
+        # Edges are sorted by source node, so the forward adjacency of a node is one contiguous slice
+        order = np.lexsort((edge_target, edge_source))
+        self.edge_source = np.asarray(edge_source, dtype=np.int32)[order]
+        self.edge_target = np.asarray(edge_target, dtype=np.int32)[order]
+        self.edge_key = np.asarray(edge_key, dtype=np.int32)[order]
+        self.edge_length = np.asarray(edge_length, dtype=np.float32)[order]
+
+        # Forward CSR: out-edges of node i are edges out_offsets[i]:out_offsets[i+1]
+        num_nodes = len(self.node_ids)
+        self.out_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.edge_source, minlength=num_nodes), out=self.out_offsets[1:])
+
+        # Reverse CSR: in-edges of node i are in_edges[in_offsets[i]:in_offsets[i+1]]
+        self.in_edges = np.argsort(self.edge_target, kind='stable').astype(np.int32)
+        self.in_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.edge_target, minlength=num_nodes), out=self.in_offsets[1:])
+
+    @classmethod
+    def from_osm_graph(cls, osm_graph):
+        node_ids = np.array(sorted(osm_graph.nodes), dtype=np.int64)
+        node_lat = np.array([osm_graph.nodes[n]['y'] for n in node_ids.tolist()])
+        node_lon = np.array([osm_graph.nodes[n]['x'] for n in node_ids.tolist()])
+        edges = list(osm_graph.edges(keys=True, data='length'))
+        edge_u = np.array([u for u, v, k, length in edges], dtype=np.int64)
+        edge_v = np.array([v for u, v, k, length in edges], dtype=np.int64)
+        edge_key = np.array([k for u, v, k, length in edges], dtype=np.int32)
+        edge_length = np.array([length for u, v, k, length in edges], dtype=np.float32)
+        return cls(node_ids, node_lat, node_lon,
+                   np.searchsorted(node_ids, edge_u), np.searchsorted(node_ids, edge_v), edge_key, edge_length)
+
+    @classmethod
+    def merge(cls, road_graphs):
+        # Union of several road graphs (e.g. overlapping map tiles), nodes and edges found in more than one are kept once
+        node_ids, first_node = np.unique(np.concatenate([road_graph.node_ids for road_graph in road_graphs]), return_index=True)
+        node_lat = np.concatenate([road_graph.node_lat for road_graph in road_graphs])[first_node]
+        node_lon = np.concatenate([road_graph.node_lon for road_graph in road_graphs])[first_node]
+        edges = np.concatenate([road_graph.edge_osm_ids(np.arange(road_graph.num_edges)) for road_graph in road_graphs])
+        edges, first_edge = np.unique(edges.reshape(-1, 3), axis=0, return_index=True)
+        edge_length = np.concatenate([road_graph.edge_length for road_graph in road_graphs])[first_edge]
+        return cls(node_ids, node_lat, node_lon,
+                   np.searchsorted(node_ids, edges[:, 0]), np.searchsorted(node_ids, edges[:, 1]), edges[:, 2], edge_length)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        # Wrap already built arrays (e.g. memory-mapped ones) without copying or re-sorting them
+        road_graph = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(road_graph, name, arrays[name])
+        return road_graph
+
+    def save(self, directory):
+        # One .npy file per array, so the graph can be memory-mapped back
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        # With mmap_mode='r' nothing is read until it is used, and processes mapping the same files share the pages
+        return cls.from_arrays({name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in cls.ARRAYS})
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_source)
+
+    @property
+    def nbytes(self):
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def fingerprint(self):
+        # Digest of the graph topology, to tell whether data derived from a graph (e.g. a route corridor) still applies
+        digest = hashlib.sha1()
+        for name in ('node_ids', 'edge_source', 'edge_target', 'edge_key'):
+            digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return digest.hexdigest()
+
+    def clip(self, bounding_box):
+        # Part of the graph inside a bounding box, like OSMnx: the nodes inside it and the edges between two of them
+        inside = ((self.node_lon >= bounding_box['left']) & (self.node_lon <= bounding_box['right']) &
+                  (self.node_lat >= bounding_box['bottom']) & (self.node_lat <= bounding_box['top']))
+        kept = inside[self.edge_source] & inside[self.edge_target]
+        new_index = np.cumsum(inside) - 1
+        return RoadGraph(self.node_ids[inside], self.node_lat[inside], self.node_lon[inside],
+                         new_index[self.edge_source[kept]], new_index[self.edge_target[kept]],
+                         self.edge_key[kept], self.edge_length[kept])
+
+    def to_networkx(self, edges=None):
+        # Materialise (part of) the graph as an OSMnx-style MultiDiGraph, e.g. for ox.plot_graph
+        edges = np.arange(self.num_edges) if edges is None else np.asarray(edges)
+        graph = nx.MultiDiGraph(crs='epsg:4326')
+        nodes = np.unique(np.concatenate((self.edge_source[edges], self.edge_target[edges])))
+        for n in nodes.tolist():
+            graph.add_node(int(self.node_ids[n]), y=float(self.node_lat[n]), x=float(self.node_lon[n]))
+        for u, v, k, length in zip(self.node_ids[self.edge_source[edges]].tolist(), self.node_ids[self.edge_target[edges]].tolist(),
+                                   self.edge_key[edges].tolist(), self.edge_length[edges].tolist()):
+            graph.add_edge(u, v, k, length=length)
+        return graph
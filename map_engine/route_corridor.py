@@ -0,0 +1,228 @@
+import hashlib
+import heapq
+import numpy as np
+from horizon import FORWARD_DISTANCE_THRESHOLD, BACKWARD_DISTANCE_THRESHOLD
+from local_projection import project_onto_segments
+
+CORRIDOR_VERSION = 1
+SAMPLE_LOOKAHEAD = 32  # corridor edges searched ahead of the current one for the edge a sample matched to
+
+class RouteCorridor:
+    # Every array that makes up the corridor, in the order they are stored in the index file
+    ARRAYS = ('edges', 'start_chainage', 'end_chainage', 'forward_offsets', 'forward_edges', 'forward_keys', 'forward_position',
+              'backward_offsets', 'backward_edges', 'backward_keys', 'backward_position', 'sample_position', 'sample_chainage')
+
+    def __init__(self, arrays, forward_threshold, backward_threshold, graph_key, track_key):
+        # A recorded drive matched once to the ordered edges it follows, with the chainage (meters along the route) of
+        # every edge and sample, and the side branches off every corridor node precomputed up to the thresholds
+        # The horizon of a sample is then a slice of the corridor around its chainage, found by binary search,
+        # plus the branches hanging off the nodes in that slice
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.forward_threshold = forward_threshold
+        self.backward_threshold = backward_threshold
+        self.graph_key = graph_key
+        self.track_key = track_key
+
+    @classmethod
+    def build(cls, road_graph, edge_index, latlongs, forward_threshold=FORWARD_DISTANCE_THRESHOLD,
+              backward_threshold=BACKWARD_DISTANCE_THRESHOLD):
+        latlongs = np.asarray(latlongs, dtype=np.float64).reshape(-1, 2)
+        matches = edge_index.match(latlongs)
+        run_starts = np.flatnonzero(np.r_[True, matches['edge'][1:] != matches['edge'][:-1]])
+        edges, breaks = route_edges(road_graph, matches['edge'][run_starts].tolist(), forward_threshold)
+
+        # Chainage along the route, a break (the drive left the graph) skips ahead by both thresholds,
+        # so no horizon ever spans it
+        lengths = road_graph.edge_length[edges].astype(np.float64)
+        gaps = np.zeros(len(edges))
+        gaps[breaks] = forward_threshold + backward_threshold
+        end_chainage = np.cumsum(lengths + gaps)
+        start_chainage = end_chainage - lengths
+
+        # Branches: everything reachable off the route within the thresholds, ahead of the target of every corridor edge
+        # and behind its source, with the distance from that corridor node
+        corridor = set(edges)
+        forward = [branch_search(road_graph, int(road_graph.edge_target[edge]), forward_threshold, corridor) for edge in edges]
+        backward = [branch_search(road_graph, int(road_graph.edge_source[edge]), backward_threshold, corridor, reverse=True) for edge in edges]
+
+        arrays = {'edges': np.array(edges, dtype=np.int64), 'start_chainage': start_chainage, 'end_chainage': end_chainage}
+        for name, branches in (('forward', forward), ('backward', backward)):
+            counts = np.array([len(branch[0]) for branch in branches], dtype=np.int64)
+            arrays[name + '_offsets'] = np.concatenate(([0], np.cumsum(counts)))
+            arrays[name + '_edges'] = np.array([edge for branch in branches for edge in branch[0]], dtype=np.int64)
+            arrays[name + '_keys'] = np.array([key for branch in branches for key in branch[1]], dtype=np.float64)
+            arrays[name + '_position'] = np.repeat(np.arange(len(edges)), counts)
+
+        arrays['sample_position'], arrays['sample_chainage'] = locate_samples(road_graph, edge_index, arrays, latlongs, matches, run_starts)
+        corridor = cls(arrays, forward_threshold, backward_threshold, road_graph.fingerprint(), track_key(latlongs))
+        print(f"Route corridor built with {len(edges)} edges ({end_chainage[-1] / 1000:.1f} km), {len(breaks)} breaks, "
+              f"{len(arrays['forward_edges'])} forward and {len(arrays['backward_edges'])} backward branch edges.")
+        return corridor
+
+    def save(self, path):
+        # One .npz index file holding the corridor, its branches and the keys of the graph and drive it was built for
+        with open(path, 'wb') as f:
+            np.savez(f, version=CORRIDOR_VERSION, forward_threshold=self.forward_threshold, backward_threshold=self.backward_threshold,
+                     graph_key=self.graph_key, track_key=self.track_key, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, path, road_graph, latlongs=None):
+        # Raises ValueError when the index was built for another road graph or (if latlongs are given) another drive
+        with np.load(path) as data:
+            if int(data['version']) != CORRIDOR_VERSION:
+                raise ValueError(f"Unsupported route corridor version {int(data['version'])}.")
+            if str(data['graph_key']) != road_graph.fingerprint():
+                raise ValueError("The route corridor was built for another road graph.")
+            if latlongs is not None and str(data['track_key']) != track_key(latlongs):
+                raise ValueError("The route corridor was built for another drive.")
+            return cls({name: data[name] for name in cls.ARRAYS}, float(data['forward_threshold']), float(data['backward_threshold']),
+                       str(data['graph_key']), str(data['track_key']))
+
+    @property
+    def sample_edge(self):
+        # Corridor edge of every sample, as an edge index into the road graph
+        return self.edges[self.sample_position]
+
+    def horizon(self, index, road_graph):
+        # Ego graph of a sample, in the same form as IncrementalHorizon.update: edge indices into the road graph,
+        # ego edge first, with the part of each edge inside the horizon as start and end fractions
+        position = int(self.sample_position[index])
+        chainage = float(self.sample_chainage[index])
+        behind, ahead = chainage - self.backward_threshold, chainage + self.forward_threshold
+
+        # Corridor edges overlapping [chainage - backward, chainage + forward]
+        first = int(np.searchsorted(self.end_chainage, behind, side='right'))
+        last = int(np.searchsorted(self.start_chainage, ahead, side='left'))
+        corridor_start = self.start_chainage[first:last]
+        corridor_length = self.end_chainage[first:last] - corridor_start
+        corridor_from = clip_fraction(behind - corridor_start, corridor_length)
+        corridor_to = clip_fraction(ahead - corridor_start, corridor_length)
+
+        # Branches off the corridor nodes ahead of the vehicle (targets of the ego edge onwards), clipped at the forward threshold
+        span = slice(self.forward_offsets[position], self.forward_offsets[last])
+        remaining = ahead - self.end_chainage[self.forward_position[span]] - self.forward_keys[span]
+        keep = remaining > 0
+        forward_edges = self.forward_edges[span][keep]
+        forward_to = clip_fraction(remaining[keep], road_graph.edge_length[forward_edges].astype(np.float64))
+
+        # Branches into the corridor nodes behind it (sources of the ego edge and before), clipped at the backward threshold
+        span = slice(self.backward_offsets[first], self.backward_offsets[position + 1])
+        remaining = self.start_chainage[self.backward_position[span]] - self.backward_keys[span] - behind
+        keep = remaining > 0
+        backward_edges = self.backward_edges[span][keep]
+        backward_from = 1 - clip_fraction(remaining[keep], road_graph.edge_length[backward_edges].astype(np.float64))
+
+        # The ego edge first, an edge found more than once is kept where it was first found
+        ego = position - first
+        edges = np.concatenate(([self.edges[position]], self.edges[first:last], forward_edges, backward_edges))
+        start = np.concatenate(([corridor_from[ego]], corridor_from, np.zeros(len(forward_edges)), backward_from))
+        end = np.concatenate(([corridor_to[ego]], corridor_to, forward_to, np.ones(len(backward_edges))))
+        unique = np.sort(np.unique(edges, return_index=True)[1])
+        return {'edge': edges[unique], 'start': start[unique], 'end': end[unique]}
+
+def clip_fraction(remaining, lengths):
+    # Fraction of each edge that fits in the remaining distance
+    return np.clip(np.divide(remaining, lengths, out=np.ones(len(lengths)), where=lengths > 0), 0, 1)
+
+def track_key(latlongs):
+    return hashlib.sha1(np.ascontiguousarray(latlongs, dtype=np.float64).tobytes()).hexdigest()
+
+def route_edges(road_graph, matched, max_detour):
+    # Turn the edges a drive was matched to (one per run of samples) into the connected sequence of edges it drove
+    # Near a junction a few samples often match the ramp instead of the road taken, these blips are dropped,
+    # edges skipped between two samples are filled in with the shortest path, and where nothing connects the route breaks
+    # Returns the edge sequence and the positions in it that start a new part after a break
+    source, target = road_graph.edge_source, road_graph.edge_target
+    edges, breaks = [], []
+    for i, edge in enumerate(matched):
+        if not edges or source[edge] == target[edges[-1]]:
+            edges.append(edge)
+        elif source[edge] == source[edges[-1]]:
+            # Left the junction on another edge than the one matched first
+            edges[-1] = edge
+        elif i + 1 < len(matched) and source[matched[i + 1]] in (target[edges[-1]], source[edges[-1]]):
+            # A blip, the next run continues the route as it was
+            continue
+        else:
+            path = shortest_path(road_graph, int(target[edges[-1]]), int(source[edge]), max_detour)
+            if path is None:
+                breaks.append(len(edges))
+            else:
+                edges.extend(path)
+            edges.append(edge)
+    return edges, breaks
+
+def shortest_path(road_graph, origin, destination, max_distance):
+    # Edges of the shortest path between two nodes, or None when it is longer than max_distance
+    key, parent, heap = {origin: 0.0}, {origin: None}, [(0.0, origin)]
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if node == destination:
+            path = []
+            while parent[node] is not None:
+                node, edge = parent[node]
+                path.append(edge)
+            return path[::-1]
+        if distance > key[node]:
+            continue
+        start, end = road_graph.out_offsets[node], road_graph.out_offsets[node + 1]
+        for edge, neighbor, length in zip(range(start, end), road_graph.edge_target[start:end].tolist(),
+                                          road_graph.edge_length[start:end].tolist()):
+            if distance + length <= max_distance and distance + length < key.get(neighbor, np.inf):
+                key[neighbor] = distance + length
+                parent[neighbor] = (node, edge)
+                heapq.heappush(heap, (distance + length, neighbor))
+    return None
+
+def branch_search(road_graph, root, threshold, corridor, reverse=False):
+    # Bounded Dijkstra from a corridor node that never drives along the corridor itself
+    # Returns the edges leaving every node reached within the threshold (entering it, when reverse),
+    # with the distance from the root to the node each one leaves from
+    key, heap = {root: 0.0}, [(0.0, root)]
+    edges, keys = [], []
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if distance > key[node]:
+            continue
+        if reverse:
+            edge_ids = road_graph.in_edges[road_graph.in_offsets[node]:road_graph.in_offsets[node + 1]].tolist()
+            neighbors = road_graph.edge_source
+        else:
+            edge_ids = range(road_graph.out_offsets[node], road_graph.out_offsets[node + 1])
+            neighbors = road_graph.edge_target
+        for edge in edge_ids:
+            if edge in corridor:
+                continue
+            edges.append(edge)
+            keys.append(distance)
+            neighbor = int(neighbors[edge])
+            following = distance + float(road_graph.edge_length[edge])
+            if following < threshold and following < key.get(neighbor, np.inf):
+                key[neighbor] = following
+                heapq.heappush(heap, (following, neighbor))
+    return edges, keys
+
+def locate_samples(road_graph, edge_index, arrays, latlongs, matches, run_starts):
+    # Corridor position and chainage of every sample, walking the corridor alongside the drive
+    # A sample matched to an edge the corridor dropped (a blip) is projected onto the corridor edge the vehicle is on
+    edges = arrays['edges'].tolist()
+    run_ends = np.r_[run_starts[1:], len(latlongs)]
+    position = np.empty(len(latlongs), dtype=np.int64)
+    fraction = np.empty(len(latlongs))
+    current = 0
+    for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+        edge = int(matches['edge'][start])
+        ahead = edges[current:current + SAMPLE_LOOKAHEAD]
+        if edge in ahead:
+            current += ahead.index(edge)
+            along = matches['backward_dist'][start:end]
+            total = along + matches['forward_dist'][start:end]
+            fraction[start:end] = np.divide(along, total, out=np.zeros(end - start), where=total > 0)
+        else:
+            xy = edge_index.projection.forward(latlongs[start:end, 0], latlongs[start:end, 1])
+            on = np.full(end - start, edges[current])
+            fraction[start:end] = project_onto_segments(edge_index.start_xy[on], edge_index.end_xy[on], xy)[0]
+        position[start:end] = current
+    lengths = arrays['end_chainage'] - arrays['start_chainage']
+    return position, arrays['start_chainage'][position] + fraction * lengths[position]
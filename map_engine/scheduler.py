@@ -0,0 +1,50 @@
+import numpy as np
+import osmnx as ox
+from horizon import FORWARD_DISTANCE_THRESHOLD
+
+UPDATE_DISTANCE = 100  # meters driven between horizon updates
+HORIZON_FRACTION = 0.25  # fraction of the forward horizon driven between updates, whichever of the two comes first
+
+class UpdateScheduler:
+    def __init__(self, update_distance=UPDATE_DISTANCE, horizon_fraction=HORIZON_FRACTION, edge_change=False,
+                 forward_threshold=FORWARD_DISTANCE_THRESHOLD):
+        # Decides which samples get a fresh horizon, the others reuse the last ego map
+        # update_distance: meters driven since the last update (None to disable)
+        # horizon_fraction: fraction of the forward horizon driven since the last update (None to disable)
+        # edge_change: also update whenever the vehicle is matched to another edge than at the last update
+        limits = [limit for limit in (update_distance, horizon_fraction * forward_threshold if horizon_fraction else None) if limit]
+        self.trigger_distance = min(limits) if limits else np.inf
+        self.edge_change = edge_change
+        self.reset()
+
+    def reset(self):
+        self.last_distance = None
+        self.last_edge = None
+        self.update_count = 0
+
+    def due(self, distance, edge=None):
+        # distance: odometer of the sample in meters, edge: the edge it is matched to
+        if (self.last_distance is not None and distance - self.last_distance < self.trigger_distance
+                and not (self.edge_change and edge != self.last_edge)):
+            return False
+        self.last_distance = distance
+        self.last_edge = edge
+        self.update_count += 1
+        return True
+
+    def schedule(self, distances, edges=None):
+        # Boolean mask of the samples of a track that get a fresh horizon, the first one always does
+        self.reset()
+        edges = [None] * len(distances) if edges is None else np.asarray(edges).tolist()
+        return np.array([self.due(distance, edge) for distance, edge in zip(np.asarray(distances).tolist(), edges)], dtype=bool)
+
+def step_distance(lat1, lon1, lat2, lon2):
+    # Great-circle distance in meters between consecutive fixes (or arrays of them), the odometer step of batch,
+    # streamed and fleet runs alike so the same drive triggers the same updates
+    return ox.distance.great_circle(lat1, lon1, lat2, lon2)
+
+def track_distance(latlongs):
+    # Odometer along a GNSS track: cumulative distance in meters at every sample
+    latlongs = np.asarray(latlongs, dtype=np.float64).reshape(-1, 2)
+    steps = step_distance(latlongs[:-1, 0], latlongs[:-1, 1], latlongs[1:, 0], latlongs[1:, 1])
+    return np.concatenate(([0.0], np.cumsum(steps)))
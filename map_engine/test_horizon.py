@@ -0,0 +1,67 @@
+import numpy as np
+from road_graph import RoadGraph
+from horizon import IncrementalHorizon, REVERSE_TOLERANCE
+
+# Run with: python -m pytest map_engine/test_horizon.py
+
+def grid_graph(seed, size=15, oneway=0.5):
+    # Jittered grid with random lengths, a share of the streets one-way in either direction
+    rng = np.random.default_rng(seed)
+    lat = np.repeat(np.arange(size), size) * 0.001 + rng.normal(0, 1e-4, size * size)
+    lon = np.tile(np.arange(size), size) * 0.001 + rng.normal(0, 1e-4, size * size)
+    sources, targets, lengths = [], [], []
+    for node in range(size * size):
+        neighbors = ([node + 1] if node % size + 1 < size else []) + ([node + size] if node + size < size * size else [])
+        for neighbor in neighbors:
+            length = rng.uniform(20, 120)
+            direction = rng.random()
+            if direction < oneway / 2:
+                sources.append(node), targets.append(neighbor), lengths.append(length)
+            elif direction < oneway:
+                sources.append(neighbor), targets.append(node), lengths.append(length)
+            else:
+                sources += [node, neighbor]
+                targets += [neighbor, node]
+                lengths += [length, length]
+    return RoadGraph(np.arange(size * size) + 100, lat, lon, sources, targets, np.zeros(len(sources)), lengths)
+
+def random_drive(road_graph, seed, steps, speed):
+    # Map matches of a random drive, (ego edge, distance to its end, distance from its start) per tick,
+    # drifting back up to REVERSE_TOLERANCE on its edge now and then like a noisy GNSS fix
+    rng = np.random.default_rng(seed)
+    edge = int(rng.integers(road_graph.num_edges))
+    position = 0.0
+    ticks = []
+    for _ in range(steps):
+        if rng.random() < 0.3:
+            position = max(position - rng.uniform(0, REVERSE_TOLERANCE), 0.0)
+        else:
+            position += rng.uniform(0, speed)
+        while position > road_graph.edge_length[edge]:
+            position -= road_graph.edge_length[edge]
+            node = road_graph.edge_target[edge]
+            following = list(range(road_graph.out_offsets[node], road_graph.out_offsets[node + 1]))
+            following = [e for e in following if road_graph.edge_target[e] != road_graph.edge_source[edge]] or following
+            if not following:
+                return ticks
+            edge = int(rng.choice(following))
+        ticks.append((edge, float(road_graph.edge_length[edge]) - position, position))
+    return ticks
+
+def horizon_ranges(road_graph, horizon):
+    # Meters of every edge inside the horizon, empty ranges left out
+    lengths = road_graph.edge_length[horizon['edge']].astype(np.float64)
+    return {edge: (start * length, end * length) for edge, start, end, length
+            in zip(horizon['edge'].tolist(), horizon['start'].tolist(), horizon['end'].tolist(), lengths.tolist()) if (end - start) * length > 0.01}
+
+def test_incremental_matches_fresh_search():
+    # Advancing one horizon tick by tick gives the same horizon as a fresh search at every tick (to the centimeter)
+    for seed in range(200):
+        road_graph = grid_graph(seed, oneway=(0.3, 0.7, 1.0)[seed % 3])
+        incremental = IncrementalHorizon(road_graph)
+        for tick in random_drive(road_graph, seed, 60, speed=(5, 40)[seed % 2]):
+            updated = horizon_ranges(road_graph, incremental.update(*tick))
+            fresh = horizon_ranges(road_graph, IncrementalHorizon(road_graph).update(*tick))
+            assert updated.keys() == fresh.keys(), (seed, tick)
+            for edge, (start, end) in fresh.items():
+                assert abs(updated[edge][0] - start) < 0.01 and abs(updated[edge][1] - end) < 0.01, (seed, tick, edge)
@@ -0,0 +1,83 @@
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from road_graph import RoadGraph
+from horizon import FORWARD_DISTANCE_THRESHOLD
+
+TILE_SIZE = 0.05  # degrees, about 5 km
+TILE_OVERLAP = 0.002  # degrees fetched beyond each tile edge, so road segments crossing it are not cut off
+METERS_PER_DEGREE = 111320
+
+class TileLoader:
+    def __init__(self, fetch, tile_size=TILE_SIZE, radius=FORWARD_DISTANCE_THRESHOLD, max_bytes=256 * 2**20, threads=2):
+        # fetch: function returning the RoadGraph of a bounding box, called on background threads
+        # radius: meters around the vehicle the road graph must cover, at least the forward horizon
+        # max_bytes: memory cap for loaded tiles, least recently used tiles beyond it are evicted
+        self.fetch = fetch
+        self.tile_size = tile_size
+        self.radius = radius
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()  # tile -> RoadGraph, least recently used first
+        self.pending = {}  # tile -> Future of a fetch running in the background
+        self.threads = threads
+        self.executor = None  # started by the first prefetch, stopped by close
+        self.fetch_count = 0
+        self.evict_count = 0
+
+    def tile_bounding_box(self, tile):
+        lat_index, lon_index = tile
+        return {
+            'left': lon_index * self.tile_size - TILE_OVERLAP,
+            'bottom': lat_index * self.tile_size - TILE_OVERLAP,
+            'right': (lon_index + 1) * self.tile_size + TILE_OVERLAP,
+            'top': (lat_index + 1) * self.tile_size + TILE_OVERLAP
+        }
+
+    def window(self, lat, lon):
+        # Tiles within radius of the position, i.e. everything the horizon can reach from there
+        lat_radius = self.radius / METERS_PER_DEGREE
+        lon_radius = lat_radius / max(math.cos(math.radians(lat)), 0.01)
+        lat_indices = range(math.floor((lat - lat_radius) / self.tile_size), math.floor((lat + lat_radius) / self.tile_size) + 1)
+        lon_indices = range(math.floor((lon - lon_radius) / self.tile_size), math.floor((lon + lon_radius) / self.tile_size) + 1)
+        return tuple((lat_index, lon_index) for lat_index in lat_indices for lon_index in lon_indices)
+
+    def prefetch(self, window):
+        # Start fetching the tiles that are neither loaded nor on their way, without waiting for them
+        for tile in window:
+            if tile not in self.tiles and tile not in self.pending:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(self.threads)
+                self.pending[tile] = self.executor.submit(self.fetch, self.tile_bounding_box(tile))
+
+    def load(self, window):
+        # Wait for every tile of the window and merge them into one road graph
+        self.prefetch(window)
+        for tile, future in list(self.pending.items()):
+            if tile in window or future.done():
+                self.tiles[tile] = future.result()
+                self.fetch_count += 1
+                del self.pending[tile]
+        for tile in window:
+            self.tiles.move_to_end(tile)
+        self.evict(window)
+        return RoadGraph.merge([self.tiles[tile] for tile in window])
+
+    def evict(self, window):
+        # Drop least recently used tiles until under the memory cap, never the ones in use
+        for tile in list(self.tiles):
+            if self.nbytes <= self.max_bytes:
+                break
+            if tile not in window:
+                del self.tiles[tile]
+                self.evict_count += 1
+
+    @property
+    def nbytes(self):
+        return sum(road_graph.nbytes for road_graph in self.tiles.values())
+
+    def close(self):
+        # Stop the background fetches, the loaded tiles are kept and a later prefetch starts new threads
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.pending = {}